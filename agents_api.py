@@ -1,8 +1,114 @@
 from config import *
+import config
 import requests
-
-
-def send_message(contract_id, text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from cache import TTLCache
+from metrics import agents_api_duration, agents_api_errors
+
+API_CONNECT_TIMEOUT = getattr(config, 'API_CONNECT_TIMEOUT', 3)
+API_READ_TIMEOUT = getattr(config, 'API_READ_TIMEOUT', 10)
+API_POOL_SIZE = getattr(config, 'API_POOL_SIZE', 32)
+API_WORKERS = getattr(config, 'API_WORKERS', 16)
+API_PREFETCH_WORKERS = getattr(config, 'API_PREFETCH_WORKERS', 4)
+RECORDS_PAGE_SIZE = getattr(config, 'RECORDS_PAGE_SIZE', 500)
+CATEGORIES_TTL = getattr(config, 'CATEGORIES_TTL', 60 * 60)
+CATEGORIES_CACHE_SIZE = getattr(config, 'CATEGORIES_CACHE_SIZE', 1024)
+
+
+class AgentsApiClient:
+    """Keep-alive connection pool to the Medsenger host with timeouts and a bounded worker pool for fan-out.
+
+    Record pagers prefetch on a separate pool: a pager may run inside a fan-out worker and wait for its
+    prefetch, which would never start if every fan-out worker were doing the same.
+    """
+
+    def __init__(self, host=MAIN_HOST, connect_timeout=API_CONNECT_TIMEOUT, read_timeout=API_READ_TIMEOUT,
+                 pool_size=API_POOL_SIZE, workers=API_WORKERS, prefetch_workers=API_PREFETCH_WORKERS):
+        self.host = host
+        self.timeout = (connect_timeout, read_timeout)
+        self.workers = workers
+        self.prefetch_workers = prefetch_workers
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, workers + prefetch_workers),
+                              pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = None
+        self._prefetch_executor = None
+        self._lock = Lock()
+
+    def post(self, path, data):
+        started = time.perf_counter()
+
+        try:
+            response = self.session.post(self.host + path, json=data, timeout=self.timeout)
+        except Exception:
+            agents_api_errors.inc(endpoint=path)
+            raise
+        finally:
+            agents_api_duration.observe(time.perf_counter() - started, endpoint=path)
+
+        if response.status_code >= 400:
+            agents_api_errors.inc(endpoint=path)
+        return response
+
+    def post_message(self, contract_id, message):
+        response = self.post('/api/agents/message', _message_data(contract_id, message))
+        response.raise_for_status()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='agents-api')
+            return self._executor
+
+    @property
+    def prefetch_executor(self):
+        with self._lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=self.prefetch_workers,
+                                                             thread_name_prefix='agents-api-prefetch')
+            return self._prefetch_executor
+
+    def map(self, fn, items, return_exceptions=False):
+        """Runs fn over items on the worker pool, results in input order.
+
+        With return_exceptions=True a failed call puts its exception in the result list instead of raising.
+        """
+
+        def call(item):
+            try:
+                return fn(item)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        return list(self.executor.map(call, items))
+
+    def send_many(self, messages):
+        """Posts (contract_id, message) pairs in parallel; returns None or the exception for each pair."""
+        return self.map(lambda pair: self.post_message(*pair), messages, return_exceptions=True)
+
+    def close(self):
+        with self._lock:
+            for executor in (self._executor, self._prefetch_executor):
+                if executor is not None:
+                    executor.shutdown()
+            self._executor = self._prefetch_executor = None
+        self.session.close()
+
+
+client = AgentsApiClient()
+
+
+def make_message(text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
                  only_patient=False, action_deadline=None, is_urgent=False, need_answer=False,
                  attachments=None):
     message = {
@@ -43,26 +149,61 @@ def send_message(contract_id, text, action_link=None, action_name=None, action_o
                 "base64": attachment[2],
             })
 
-    data = {
+    return message
+
+
+def _message_data(contract_id, message):
+    return {
         "contract_id": contract_id,
         "api_key": APP_KEY,
         "message": message
     }
 
+
+def post_message(contract_id, message):
+    """Delivers a message built by make_message. Unlike send_message, errors are raised to the caller."""
+    client.post_message(contract_id, message)
+
+
+def send_message(contract_id, text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
+                 only_patient=False, action_deadline=None, is_urgent=False, need_answer=False,
+                 attachments=None):
+    message = make_message(text, action_link=action_link, action_name=action_name, action_onetime=action_onetime,
+                           only_doctor=only_doctor, only_patient=only_patient, action_deadline=action_deadline,
+                           is_urgent=is_urgent, need_answer=need_answer, attachments=attachments)
+
     try:
-        requests.post(MAIN_HOST + '/api/agents/message', json=data)
+        post_message(contract_id, message)
     except Exception as e:
         print('connection error', e)
 
 
+categories_cache = TTLCache(1, CATEGORIES_TTL)
+available_categories_cache = TTLCache(CATEGORIES_CACHE_SIZE, CATEGORIES_TTL)
+
+
+def invalidate_categories(contract_id=None):
+    """Drops cached categories of a contract, or the whole catalog and every contract's list when called bare."""
+    if contract_id is None:
+        categories_cache.clear()
+        available_categories_cache.clear()
+    else:
+        available_categories_cache.pop(contract_id)
+
+
+def _load_json(path, data):
+    response = client.post(path, data)
+    response.raise_for_status()
+    return response.json()
+
+
 def get_categories():
     data = {
         "api_key": APP_KEY,
     }
 
     try:
-        result = requests.post(MAIN_HOST + '/api/agents/records/categories', json=data)
-        return result.json()
+        return categories_cache.get_or_load(None, lambda: _load_json('/api/agents/records/categories', data))
     except Exception as e:
         print('connection error', e)
         return {}
@@ -75,14 +216,14 @@ def get_available_categories(contract_id):
     }
 
     try:
-        result = requests.post(MAIN_HOST + '/api/agents/records/available_categories', json=data)
-        return result.json()
+        return available_categories_cache.get_or_load(
+            contract_id, lambda: _load_json('/api/agents/records/available_categories', data))
     except Exception as e:
         print('connection error', e)
         return {}
 
 
-def get_records(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
+def _records_query(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -98,15 +239,116 @@ def get_records(contract_id, category_name, time_from=None, time_to=None, limit=
     if time_to:
         data['to'] = time_to
 
+    return data
+
+
+def get_records(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
+    data = _records_query(contract_id, category_name, time_from, time_to, limit, offset)
+
     try:
-        result = requests.post(MAIN_HOST + '/api/agents/records/get', json=data)
+        result = client.post('/api/agents/records/get', data)
         return result.json()
     except Exception as e:
         print('connection error', e)
         return {}
 
 
-def add_record(contract_id, category_name, value, record_time=None):
+def _records_page(answer):
+    if isinstance(answer, dict):
+        return answer.get('values') or []
+    return answer or []
+
+
+class RecordsPager:
+    """Iterates over the records of a contract's category page by page, keeping at most two pages in memory.
+
+    Pages are fetched with limit/offset inside a window fixed when iteration starts, so records added meanwhile
+    don't shift the offsets; with prefetch on, the next page is requested on the client's prefetch pool while the
+    current one is consumed. The server may cap the limit below page_size, so only an empty page ends the
+    iteration, not a short one. Records are expected oldest first. `watermark` is the newest timestamp yielded so
+    far and `boundary_ids` the ids yielded at that timestamp: pass both back as time_from and skip_ids (or call
+    resume()) to continue later without repeating records.
+    """
+
+    def __init__(self, contract_id, category_name, time_from=None, time_to=None, page_size=RECORDS_PAGE_SIZE,
+                 prefetch=True, skip_ids=(), api=None):
+        self.contract_id = contract_id
+        self.category_name = category_name
+        self.time_from = time_from
+        self.time_to = time_to
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.skip_ids = set(skip_ids)
+        self.api = api or client
+
+        self.watermark = time_from
+        self.boundary_ids = set(skip_ids)
+        self.pages = 0
+
+    def query(self, time_to, offset):
+        return _records_query(self.contract_id, self.category_name, self.time_from, time_to, self.page_size, offset)
+
+    def accept(self, record):
+        """Moves the watermark past the record, or returns False if it was already yielded before a resume."""
+        if record.get('id') in self.skip_ids and record.get('timestamp') == self.time_from:
+            return False
+
+        timestamp = record.get('timestamp')
+        if timestamp is not None:
+            if self.watermark is None or timestamp > self.watermark:
+                self.watermark = timestamp
+                self.boundary_ids = set()
+            if timestamp == self.watermark:
+                self.boundary_ids.add(record.get('id'))
+
+        return True
+
+    def resume(self):
+        return type(self)(self.contract_id, self.category_name, self.watermark, None, self.page_size, self.prefetch,
+                          self.boundary_ids, self.api)
+
+    def fetch(self, time_to, offset):
+        response = self.api.post('/api/agents/records/get', self.query(time_to, offset))
+        response.raise_for_status()
+        return _records_page(response.json())
+
+    def __iter__(self):
+        time_to = self.time_to or int(time.time())
+        offset = 0
+        pending = None
+
+        try:
+            page = self.fetch(time_to, offset)
+
+            while True:
+                self.pages += 1
+                offset += len(page)
+                last = not page
+
+                if not last and self.prefetch:
+                    pending = self.api.prefetch_executor.submit(self.fetch, time_to, offset)
+
+                for record in page:
+                    if self.accept(record):
+                        yield record
+
+                if last:
+                    return
+
+                page = pending.result() if pending else self.fetch(time_to, offset)
+                pending = None
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+
+def iter_records(contract_id, category_name, time_from=None, time_to=None, page_size=RECORDS_PAGE_SIZE, prefetch=True,
+                 skip_ids=()):
+    """Streaming counterpart of get_records; unlike it, connection errors are raised to the caller."""
+    return RecordsPager(contract_id, category_name, time_from, time_to, page_size, prefetch, skip_ids)
+
+
+def _record_data(contract_id, category_name, value, record_time=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -117,13 +359,19 @@ def add_record(contract_id, category_name, value, record_time=None):
     if record_time:
         data['time'] = record_time
 
+    return data
+
+
+def add_record(contract_id, category_name, value, record_time=None):
+    data = _record_data(contract_id, category_name, value, record_time)
+
     try:
-        requests.post(MAIN_HOST + '/api/agents/records/add', json=data)
+        client.post('/api/agents/records/add', data)
     except Exception as e:
         print('connection error', e)
 
 
-def add_records(contract_id, values, record_time=None):
+def _records_data(contract_id, values, record_time=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -134,14 +382,20 @@ def add_records(contract_id, values, record_time=None):
                           (category_name, value) in values]
     else:
         data['values'] = [{"category_name": category_name, "value": value} for (category_name, value) in values]
+
+    return data
+
+
+def add_records(contract_id, values, record_time=None):
+    data = _records_data(contract_id, values, record_time)
     print(data)
     try:
-        requests.post(MAIN_HOST + '/api/agents/records/add', json=data)
+        client.post('/api/agents/records/add', data)
     except Exception as e:
         print('connection error', e)
 
 
-def add_task(contract_id, text, number=1, date=None, important=False, action_link=None):
+def _task_data(contract_id, text, number=1, date=None, important=False, action_link=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -156,8 +410,14 @@ def add_task(contract_id, text, number=1, date=None, important=False, action_lin
     if action_link:
         data['action_link'] = action_link
 
+    return data
+
+
+def add_task(contract_id, text, number=1, date=None, important=False, action_link=None):
+    data = _task_data(contract_id, text, number, date, important, action_link)
+
     try:
-        response = requests.post(MAIN_HOST + '/api/agents/tasks/add', json=data)
+        response = client.post('/api/agents/tasks/add', data)
         print(response)
         answer = response.json()
         return answer['task_id']
@@ -173,7 +433,7 @@ def make_task(contract_id, task_id):
     }
 
     try:
-        answer = requests.post(MAIN_HOST + '/api/agents/tasks/done', json=data).json()
+        answer = client.post('/api/agents/tasks/done', data).json()
         return answer['is_done']
 
     except Exception as e:
@@ -188,6 +448,6 @@ def delete_task(contract_id, task_id):
     }
 
     try:
-        requests.post(MAIN_HOST + '/api/agents/tasks/delete', json=data)
+        client.post('/api/agents/tasks/delete', data)
     except Exception as e:
         print('connection error', e)
@@ -0,0 +1,268 @@
+import asyncio
+import aiohttp
+import time
+from config import *
+import config
+from agents_api import API_CONNECT_TIMEOUT, API_READ_TIMEOUT, API_POOL_SIZE, RECORDS_PAGE_SIZE, RecordsPager, \
+    make_message, categories_cache, available_categories_cache, _message_data, _records_query, _records_page, \
+    _record_data, _records_data, _task_data
+from metrics import agents_api_duration, agents_api_errors
+
+API_CONCURRENCY = getattr(config, 'API_CONCURRENCY', 64)
+
+
+class AsyncAgentsApiClient:
+    """asyncio counterpart of agents_api.AgentsApiClient.
+
+    The aiohttp session is created lazily inside the running loop and shared by all calls. A semaphore caps
+    the number of requests in flight; both it and the pooled connection are released if the caller is cancelled.
+    Both belong to the loop they were created in, so they are recreated when the client is used from another
+    loop, e.g. by consecutive asyncio.run() calls.
+    """
+
+    def __init__(self, host=MAIN_HOST, connect_timeout=API_CONNECT_TIMEOUT, read_timeout=API_READ_TIMEOUT,
+                 pool_size=API_POOL_SIZE, concurrency=API_CONCURRENCY):
+        self.host = host
+        self.timeout = aiohttp.ClientTimeout(total=connect_timeout + read_timeout, connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+
+        if self._session is None or self._session.closed or self._loop is not loop:
+            # a session left from another loop can't be closed from this one; its connections go with that loop
+            self._loop = loop
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                                  timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def post(self, path, data, decode=True, raise_for_status=False):
+        """Posts data and returns the decoded JSON answer, or None when decode is off."""
+        session = self._get_session()
+
+        async with self._semaphore:
+            started = time.perf_counter()
+
+            try:
+                async with session.post(self.host + path, json=data) as response:
+                    if response.status >= 400:
+                        agents_api_errors.inc(endpoint=path)
+                    if raise_for_status:
+                        response.raise_for_status()
+                    if not decode:
+                        await response.read()
+                        return None
+                    return await response.json(content_type=None)
+            except aiohttp.ClientResponseError:
+                raise
+            except Exception:
+                agents_api_errors.inc(endpoint=path)
+                raise
+            finally:
+                agents_api_duration.observe(time.perf_counter() - started, endpoint=path)
+
+    async def post_message(self, contract_id, message):
+        await self.post('/api/agents/message', _message_data(contract_id, message), decode=False,
+                        raise_for_status=True)
+
+    async def send_many(self, messages):
+        """Posts (contract_id, message) pairs concurrently; returns None or the exception for each pair."""
+        results = await asyncio.gather(*[self.post_message(contract_id, message) for contract_id, message in messages],
+                                       return_exceptions=True)
+        return [result if isinstance(result, BaseException) else None for result in results]
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+
+client = AsyncAgentsApiClient()
+_loading = {}
+
+
+async def _load_cached(cache, key, path, data):
+    """Async side of the category caches: shares entries with agents_api and runs one request per missing key."""
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    # a task can only be awaited in its own loop
+    loading = (asyncio.get_running_loop(), path, key)
+    task = _loading.get(loading)
+    if task is None:
+        # skipped by the cache if the key is invalidated while the request is in flight
+        generation = cache.begin_load(key)
+
+        def store(done):
+            _loading.pop(loading, None)
+            if not done.cancelled() and done.exception() is None:
+                cache.end_load(key, generation, done.result())
+            else:
+                cache.end_load(key, generation)
+
+        task = _loading[loading] = asyncio.ensure_future(client.post(path, data, raise_for_status=True))
+        task.add_done_callback(store)
+
+    return await asyncio.shield(task)
+
+
+async def post_message(contract_id, message):
+    await client.post_message(contract_id, message)
+
+
+async def send_message(contract_id, text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
+                       only_patient=False, action_deadline=None, is_urgent=False, need_answer=False,
+                       attachments=None):
+    message = make_message(text, action_link=action_link, action_name=action_name, action_onetime=action_onetime,
+                           only_doctor=only_doctor, only_patient=only_patient, action_deadline=action_deadline,
+                           is_urgent=is_urgent, need_answer=need_answer, attachments=attachments)
+
+    try:
+        await post_message(contract_id, message)
+    except Exception as e:
+        print('connection error', e)
+
+
+async def get_categories():
+    data = {
+        "api_key": APP_KEY,
+    }
+
+    try:
+        return await _load_cached(categories_cache, None, '/api/agents/records/categories', data)
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+async def get_available_categories(contract_id):
+    data = {
+        "contract_id": contract_id,
+        "api_key": APP_KEY,
+    }
+
+    try:
+        return await _load_cached(available_categories_cache, contract_id, '/api/agents/records/available_categories',
+                                  data)
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+async def get_records(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
+    data = _records_query(contract_id, category_name, time_from, time_to, limit, offset)
+
+    try:
+        return await client.post('/api/agents/records/get', data)
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+class AsyncRecordsPager(RecordsPager):
+    """RecordsPager for `async for`; the next page is prefetched as a task on the running loop."""
+
+    async def fetch(self, time_to, offset):
+        return _records_page(await self.api.post('/api/agents/records/get', self.query(time_to, offset),
+                                                 raise_for_status=True))
+
+    def __iter__(self):
+        raise TypeError("use async for")
+
+    async def __aiter__(self):
+        time_to = self.time_to or int(time.time())
+        offset = 0
+        pending = None
+
+        try:
+            page = await self.fetch(time_to, offset)
+
+            while True:
+                self.pages += 1
+                offset += len(page)
+                last = not page
+
+                if not last and self.prefetch:
+                    pending = asyncio.ensure_future(self.fetch(time_to, offset))
+
+                for record in page:
+                    if self.accept(record):
+                        yield record
+
+                if last:
+                    return
+
+                page = await pending if pending else await self.fetch(time_to, offset)
+                pending = None
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+
+def iter_records(contract_id, category_name, time_from=None, time_to=None, page_size=RECORDS_PAGE_SIZE, prefetch=True,
+                 skip_ids=()):
+    return AsyncRecordsPager(contract_id, category_name, time_from, time_to, page_size, prefetch, skip_ids, client)
+
+
+async def add_record(contract_id, category_name, value, record_time=None):
+    data = _record_data(contract_id, category_name, value, record_time)
+
+    try:
+        await client.post('/api/agents/records/add', data, decode=False)
+    except Exception as e:
+        print('connection error', e)
+
+
+async def add_records(contract_id, values, record_time=None):
+    data = _records_data(contract_id, values, record_time)
+
+    try:
+        await client.post('/api/agents/records/add', data, decode=False)
+    except Exception as e:
+        print('connection error', e)
+
+
+async def add_task(contract_id, text, number=1, date=None, important=False, action_link=None):
+    data = _task_data(contract_id, text, number, date, important, action_link)
+
+    try:
+        answer = await client.post('/api/agents/tasks/add', data)
+        return answer['task_id']
+    except Exception as e:
+        print('connection error', e)
+
+
+async def make_task(contract_id, task_id):
+    data = {
+        "contract_id": contract_id,
+        "api_key": APP_KEY,
+        "task_id": task_id,
+    }
+
+    try:
+        answer = await client.post('/api/agents/tasks/done', data)
+        return answer['is_done']
+    except Exception as e:
+        print('connection error', e)
+
+
+async def delete_task(contract_id, task_id):
+    data = {
+        "contract_id": contract_id,
+        "api_key": APP_KEY,
+        "task_id": task_id,
+    }
+
+    try:
+        await client.post('/api/agents/tasks/delete', data, decode=False)
+    except Exception as e:
+        print('connection error', e)
@@ -0,0 +1,396 @@
+"""Benchmarks the bot's hot paths on a synthetic dataset.
+
+    python benchmark.py --database sqlite:///benchmark.db --scale 100x5x20 --scale 1000x10x40 --output bench.json
+
+A scale is CONTRACTSxPROTOCOLSxEVENTS (events per protocol). Every scale recreates the schema in the
+target database, so point --database at a throwaway database. Results are written as JSON with timings
+and statement counts for each operation, to be compared between commits.
+
+With --check-plans, the SELECTs issued by the scheduler and the page handlers are captured and run through
+EXPLAIN at every scale; the script exits with status 1 if any of them scans a whole table listed in
+PLAN_TABLES (on Postgres with enable_seqscan off, so a sequential scan means no usable index exists).
+
+With --api-host pointing at fake_medsenger.py, the outbox filled by send_iteration is also drained through
+dispatch_outbox, measuring delivery throughput against the injected latency, errors and rate limits.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import event, text
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PLAN_TABLES = {'contract', 'contract_protocols', 'event', 'event_results', 'contract_event_schedule',
+               'outbox_message', 'data_version'}
+# contract is no wider than its partial index on active rows, so SQLite rightly prefers scanning the table
+SQLITE_SCANNABLE = {'contract'}
+
+
+def load_bot(database):
+    os.environ['DATABASE_URL'] = database
+    sys.path.insert(0, ROOT)
+    from wsgi import bot
+    return bot
+
+
+def parse_scale(value):
+    contracts, protocols, events = [int(part) for part in value.lower().split('x')]
+    return {"contracts": contracts, "protocols": protocols, "events": events}
+
+
+def generate_dataset(bot, contracts, protocols, events, coverage=0.6, seed=1):
+    """Fills an empty schema with `contracts` contracts attached to 1-3 of `protocols` protocols
+    of `events` events each. Start dates are spread over the last 120 days. Like in production, every
+    event whose notification date has passed has an EventResults row and a delivered outbox message;
+    `coverage` is the share of those rows with confirmations filled in."""
+    rnd = random.Random(seed)
+    db = bot.db
+    today = date.today()
+
+    db.session.execute(bot.insert(bot.Protocol), [
+        {"id": p, "title": "Protocol {}".format(p), "description": "Synthetic protocol"}
+        for p in range(1, protocols + 1)])
+
+    event_rows = []
+    for p in range(1, protocols + 1):
+        for e in range(events):
+            start_day = rnd.randint(0, 120)
+            notify = rnd.random() < 0.9
+            event_rows.append({
+                "id": len(event_rows) + 1, "protocol_id": p, "is_required": rnd.random() < 0.8,
+                "patient_title": "Event {}.{}".format(p, e), "patient_description": "Synthetic event",
+                "start_day": start_day, "end_day": start_day + rnd.randint(1, 14),
+                "notification_day": start_day,
+                "notify_doctor": notify and rnd.random() < 0.5, "notify_patient": notify,
+                "need_confirmation_doctor": rnd.random() < 0.3, "need_confirmation_patient": rnd.random() < 0.5,
+                "need_comment_doctor": False, "need_comment_patient": rnd.random() < 0.2,
+            })
+    db.session.execute(bot.insert(bot.Event), event_rows)
+
+    events_by_protocol = {}
+    for row in event_rows:
+        events_by_protocol.setdefault(row['protocol_id'], []).append(row)
+
+    contract_rows = []
+    connection_rows = []
+    result_rows = []
+
+    for c in range(1, contracts + 1):
+        contract_rows.append({"id": c, "active": rnd.random() < 0.9})
+
+        for p in rnd.sample(range(1, protocols + 1), min(protocols, rnd.randint(1, 3))):
+            start = today - timedelta(days=rnd.randint(0, 120))
+            connection_rows.append({"contract_id": c, "protocol_id": p, "start": start})
+
+            for event in events_by_protocol[p]:
+                if start + timedelta(days=event['notification_day']) >= today:
+                    continue
+
+                end = start + timedelta(days=event['end_day'])
+                filled = rnd.random() < coverage
+                result_rows.append({
+                    "contract_id": c, "event_id": event['id'],
+                    "patient_confirmation": end - timedelta(days=rnd.randint(-3, 5)) if filled else None,
+                    "doctor_confirmation": end - timedelta(days=rnd.randint(-3, 5)) if filled and rnd.random() < 0.5 else None,
+                })
+
+    db.session.execute(bot.insert(bot.Contract), contract_rows)
+    db.session.execute(bot.insert(bot.ContractProtocols), connection_rows)
+    if result_rows:
+        db.session.execute(bot.insert(bot.EventResults), result_rows)
+
+        sent = datetime.now() - timedelta(days=1)
+        db.session.execute(bot.insert(bot.OutboxMessage), [
+            {"contract_id": row['contract_id'], "message": '{"text": "", "only_patient": true}', "status": 'sent',
+             "attempts": 0, "next_attempt": sent, "created": sent, "sent": sent} for row in result_rows])
+
+    bot.refresh_event_schedule()
+    db.session.commit()
+
+    return {"connections": connection_rows, "results": len(result_rows)}
+
+
+def clear_caches(bot):
+    for cache in (bot.protocol_cache, bot.page_cache, bot.actions_cache):
+        cache.clear()
+    bot.tracked_contracts.version = None
+
+
+def reset_schema(bot):
+    bot.db.session.remove()
+    bot.db.drop_all()
+    bot.db.create_all()
+    clear_caches(bot)
+
+
+def summarize(name, timings, queries, db_times=()):
+    timings = sorted(timings)
+    return {
+        "operation": name,
+        "runs": len(timings),
+        "mean_ms": statistics.mean(timings) * 1000,
+        "p50_ms": timings[len(timings) // 2] * 1000,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        "max_ms": timings[-1] * 1000,
+        "queries": max(queries) if queries else None,
+        "db_ms": statistics.mean(db_times) * 1000 if db_times else None,
+    }
+
+
+def time_request(client, method, url, **kwargs):
+    started = time.perf_counter()
+    response = getattr(client, method)(url, **kwargs)
+    elapsed = time.perf_counter() - started
+
+    if response.status_code >= 400 or response.data == b'error':
+        raise RuntimeError("{} {} failed with {}".format(method.upper(), url, response.status_code))
+
+    return elapsed, int(response.headers.get('X-Query-Count', 0)), float(response.headers.get('X-Query-Time', 0)) / 1000
+
+
+def run_requests(bot, name, requests, cold):
+    timings = []
+    queries = []
+    db_times = []
+    client = bot.app.test_client()
+
+    if not cold:
+        for method, url, kwargs in requests:
+            time_request(client, method, url, **kwargs)
+
+    for method, url, kwargs in requests:
+        if cold:
+            clear_caches(bot)
+        elapsed, count, db_time = time_request(client, method, url, **kwargs)
+        timings.append(elapsed)
+        queries.append(count)
+        db_times.append(db_time)
+
+    return summarize(name, timings, queries, db_times)
+
+
+def run_dispatch(bot):
+    """Drains the outbox once: every pending message gets one delivery attempt."""
+    Outbox = bot.OutboxMessage
+    pending = Outbox.query.filter_by(status='pending').count()
+    batches = []
+
+    with bot.query_stats.track('benchmark') as stats:
+        started = time.perf_counter()
+        while True:
+            batch_started = time.perf_counter()
+            claimed = bot.dispatch_outbox()
+            if not claimed:
+                break
+            batches.append(time.perf_counter() - batch_started)
+        elapsed = time.perf_counter() - started
+
+    sent = Outbox.query.filter_by(status='sent').count()
+    result = summarize('dispatch_batch', batches or [elapsed], [stats.count], [stats.duration])
+    result.update({"messages": pending, "sent": sent, "failed": pending - sent, "total_s": elapsed,
+                   "messages_per_s": pending / elapsed if elapsed else None})
+    return result
+
+
+def capture_selects(bot, fn):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(bot.db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(bot.db.engine, 'before_cursor_execute', before_cursor_execute)
+        bot.db.session.rollback()
+
+    return statements
+
+
+def get_seq_scans(node):
+    scans = [node['Relation Name']] if node.get('Node Type') == 'Seq Scan' else []
+    for child in node.get('Plans', []):
+        scans += get_seq_scans(child)
+    return scans
+
+
+def explain(bot, statement, parameters):
+    """Returns (plan text, tables read in full) for one captured statement."""
+    with bot.db.engine.connect() as connection:
+        with connection.begin() as transaction:
+            if bot.is_postgres():
+                connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+                plan = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                scans = get_seq_scans(plan[0]['Plan'])
+                text = json.dumps(plan)
+            else:
+                rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+                details = [row[-1] for row in rows]
+                scans = [detail.split()[1] for detail in details
+                         if detail.startswith('SCAN ') and 'INDEX' not in detail and len(detail.split()) > 1]
+                text = '\n'.join(details)
+                scans = [table for table in scans if table not in SQLITE_SCANNABLE]
+            transaction.rollback()
+
+    return text, [table for table in scans if table in PLAN_TABLES]
+
+
+def check_plans(bot, picks):
+    key = bot.APP_KEY
+    today = date.today()
+    client = bot.app.test_client()
+    pick = picks[0]
+
+    operations = [
+        ('get_due_notifications', lambda: bot.get_due_notifications(today)),
+        ('get_notification_dates', lambda: bot.get_notification_dates(today)),
+        ('get_pending_outbox', lambda: bot.get_pending_outbox(datetime.now()).all()),
+        ('protocol_page_doctor', lambda: client.get('/protocol/{}/doctor?api_key={}&contract_id={}'.format(
+            pick['protocol_id'], key, pick['contract_id']))),
+        ('protocol_page_patient', lambda: client.get('/protocol/{}/patient?api_key={}&contract_id={}'.format(
+            pick['protocol_id'], key, pick['contract_id']))),
+        ('settings', lambda: client.get('/settings?api_key={}&contract_id={}'.format(key, pick['contract_id']))),
+        ('status', lambda: client.post('/status', json={'api_key': key})),
+        ('actions', lambda: client.post('/actions', json={'api_key': key, 'contract_id': pick['contract_id']})),
+    ]
+
+    bot.db.session.execute(text('ANALYZE'))
+    bot.db.session.commit()
+
+    results = []
+    for name, fn in operations:
+        clear_caches(bot)
+        seen = set()
+
+        for statement, parameters in capture_selects(bot, fn):
+            if statement in seen:
+                continue
+            seen.add(statement)
+
+            plan, scans = explain(bot, statement, parameters)
+            results.append({"operation": name, "statement": ' '.join(statement.split()), "plan": plan,
+                            "seq_scans": scans})
+
+    return results
+
+
+def run_scale(bot, scale, repeat, seed, api_host=None, plans=False):
+    reset_schema(bot)
+
+    started = time.perf_counter()
+    dataset = generate_dataset(bot, scale['contracts'], scale['protocols'], scale['events'], seed=seed)
+    generated = time.perf_counter() - started
+
+    rnd = random.Random(seed)
+    key = bot.APP_KEY
+    connections = dataset['connections']
+    picks = [rnd.choice(connections) for _ in range(repeat)]
+    results = []
+
+    with bot.query_stats.track('benchmark') as stats:
+        started = time.perf_counter()
+        bot.send_iteration()
+        elapsed = time.perf_counter() - started
+    results.append(summarize('send_iteration', [elapsed], [stats.count], [stats.duration]))
+
+    with bot.query_stats.track('benchmark') as stats:
+        started = time.perf_counter()
+        bot.send_iteration()
+        elapsed = time.perf_counter() - started
+    results.append(summarize('send_iteration_idle', [elapsed], [stats.count], [stats.duration]))
+
+    if api_host:
+        bot.client.host = api_host
+        results.append(run_dispatch(bot))
+
+    for client_role in ('doctor', 'patient'):
+        page_requests = [('get', '/protocol/{}/{}?api_key={}&contract_id={}'.format(
+            c['protocol_id'], client_role, key, c['contract_id']), {}) for c in picks]
+        results.append(run_requests(bot, 'protocol_page_{}'.format(client_role), page_requests, cold=True))
+        results.append(run_requests(bot, 'protocol_page_{}_cached'.format(client_role), page_requests, cold=False))
+
+    settings_requests = []
+    for c in picks:
+        form = {'protocol_{}'.format(c['protocol_id']): 'on',
+                'protocol_{}_date'.format(c['protocol_id']): str(c['start'] + timedelta(days=rnd.randint(-3, 3)))}
+        settings_requests.append(('post', '/settings?api_key={}&contract_id={}'.format(key, c['contract_id']),
+                                  {'data': form}))
+    results.append(run_requests(bot, 'setting_save', settings_requests, cold=True))
+
+    status_requests = [('post', '/status', {'json': {'api_key': key}})] * repeat
+    results.append(run_requests(bot, 'status', status_requests, cold=True))
+    results.append(run_requests(bot, 'status_cached', status_requests, cold=False))
+
+    actions_requests = [('post', '/actions', {'json': {'api_key': key, 'contract_id': c['contract_id']}})
+                        for c in picks]
+    results.append(run_requests(bot, 'actions', actions_requests, cold=True))
+    results.append(run_requests(bot, 'actions_cached', actions_requests, cold=False))
+
+    report = {"scale": scale, "generate_s": generated, "results": dataset['results'], "operations": results}
+    if plans:
+        report['plans'] = check_plans(bot, picks)
+    return report
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default='sqlite:///' + os.path.join(ROOT, 'benchmark.db'))
+    parser.add_argument('--scale', action='append', type=parse_scale,
+                        help='CONTRACTSxPROTOCOLSxEVENTS, may be repeated (default 100x5x20 and 1000x10x40)')
+    parser.add_argument('--repeat', type=int, default=20, help='requests per operation')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='JSON file to write, stdout if omitted')
+    parser.add_argument('--check-plans', action='store_true',
+                        help='EXPLAIN the hot queries and fail on full scans of large tables')
+    parser.add_argument('--api-host', default=None, help='Medsenger host to dispatch the outbox to, e.g. '
+                                                         'http://127.0.0.1:9090 for fake_medsenger.py')
+    args = parser.parse_args()
+
+    bot = load_bot(args.database)
+    report = {
+        "commit": get_commit(),
+        "database": bot.db.engine.dialect.name,
+        "created": datetime.now().isoformat(),
+        "repeat": args.repeat,
+        "api_host": args.api_host,
+        "scales": [],
+    }
+
+    for scale in args.scale or [parse_scale('100x5x20'), parse_scale('1000x10x40')]:
+        print('benchmarking {contracts} contracts, {protocols} protocols, {events} events'.format(**scale),
+              file=sys.stderr)
+        report['scales'].append(run_scale(bot, scale, args.repeat, args.seed, args.api_host, args.check_plans))
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failed = [(scale['scale'], plan) for scale in report['scales'] for plan in scale.get('plans', [])
+              if plan['seq_scans']]
+    for scale, plan in failed:
+        print('full scan of {} in {} at {}: {}'.format(', '.join(plan['seq_scans']), plan['operation'], scale,
+                                                       plan['statement']), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
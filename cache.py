@@ -0,0 +1,150 @@
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe mapping that evicts the least recently used entry once maxsize is reached."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, MISSING)
+            if value is MISSING:
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.store(key, value)
+
+    def store(self, key, value):
+        """set() for callers already holding the lock."""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Flight:
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose entries expire ttl seconds after they are set.
+
+    get_or_load runs the loader once per key however many threads miss at the same time; the others wait for
+    its result, or get its exception. Failed loads are not cached, and neither are loads that overlapped an
+    invalidation: pop() and clear() advance the key's generation, and a value loaded under an older
+    generation is returned to its callers but not stored. Generations are only kept for keys with a load
+    in flight (between begin_load and end_load), so they don't grow with the number of keys invalidated.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.flights = {}
+        self.loads = {}
+        self.generations = {}
+        self.cleared = 0
+
+    def begin_load(self, key):
+        """Registers a load of key; pass the returned generation to end_load."""
+        with self.lock:
+            self.loads[key] = self.loads.get(key, 0) + 1
+            return self.cleared, self.generations.get(key, 0)
+
+    def end_load(self, key, generation, value=MISSING):
+        """Finishes a load, storing value unless the key was invalidated since begin_load or the load failed."""
+        with self.lock:
+            if value is not MISSING and generation == (self.cleared, self.generations.get(key, 0)):
+                self.store(key, (time.monotonic() + self.ttl, value))
+
+            self.loads[key] -= 1
+            if not self.loads[key]:
+                del self.loads[key]
+                self.generations.pop(key, None)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is MISSING:
+                return default
+
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key in self.loads:
+                self.generations[key] = self.generations.get(key, 0) + 1
+            entry = self.entries.pop(key, MISSING)
+        return default if entry is MISSING else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.cleared += 1
+            self.generations.clear()
+            self.entries.clear()
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        generation = self.begin_load(key)
+        value = MISSING
+
+        try:
+            value = flight.value = loader()
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self.end_load(key, generation, value)
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
@@ -0,0 +1,403 @@
+"""Stand-in for the Medsenger agents API, for load-testing delivery without the real host.
+
+    python fake_medsenger.py --port 9090 --latency lognormal:40:0.5 --error-rate 0.05 --rate-limit 200
+
+and point MAIN_HOST (or `benchmark.py --api-host`) at http://127.0.0.1:9090.
+
+Latency is a distribution in milliseconds: `50`, `uniform:10:100`, `normal:50:10`, `lognormal:MEDIAN:SIGMA`
+or `exp:MEAN`. Failures are injected as random error statuses (--error-rate), requests that hang past the
+client's timeout (--hang-rate) and a token bucket answering 429 (--rate-limit, --burst). Per-endpoint settings
+override the global ones, e.g. `--endpoint /api/agents/message:latency=normal:80:20,error_rate=0.1`.
+
+Every request is recorded and can be read back, with settings changed at runtime through:
+
+    GET  /_fake/stats       request counts by endpoint and status, latency percentiles
+    GET  /_fake/requests    recorded payloads, filtered by ?path= and limited by ?limit=
+    POST /_fake/config      JSON with the same keys as --endpoint, plus "endpoints": {path: {...}}
+    POST /_fake/reset       forgets recorded requests, records, tasks and counters
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import time
+from collections import deque
+from threading import Lock
+from flask import Flask, request, jsonify
+
+CATEGORIES = [
+    {"id": 1, "name": "systolic_pressure", "description": "Систолическое давление", "unit": "мм рт. ст.",
+     "type": "integer", "default_representation": "scatter"},
+    {"id": 2, "name": "diastolic_pressure", "description": "Диастолическое давление", "unit": "мм рт. ст.",
+     "type": "integer", "default_representation": "scatter"},
+    {"id": 3, "name": "pulse", "description": "Пульс", "unit": "уд/мин", "type": "integer",
+     "default_representation": "scatter"},
+    {"id": 4, "name": "temperature", "description": "Температура", "unit": "°C", "type": "float",
+     "default_representation": "scatter"},
+    {"id": 5, "name": "weight", "description": "Вес", "unit": "кг", "type": "float",
+     "default_representation": "scatter"},
+    {"id": 6, "name": "glukose", "description": "Глюкоза", "unit": "ммоль/л", "type": "float",
+     "default_representation": "scatter"},
+    {"id": 7, "name": "information", "description": "Информация", "unit": "", "type": "string",
+     "default_representation": "values"},
+]
+VALUE_RANGES = {
+    "systolic_pressure": (100, 170), "diastolic_pressure": (60, 110), "pulse": (50, 120),
+    "temperature": (35.5, 39.5), "weight": (50, 120), "glukose": (3.5, 12.0),
+}
+
+SETTING_KEYS = ('latency', 'error_rate', 'error_status', 'hang_rate', 'hang')
+
+
+def parse_latency(spec):
+    """Returns a function that draws a delay in seconds from a distribution given in milliseconds."""
+    if callable(spec):
+        return spec
+
+    kind, _, args = str(spec).partition(':')
+    try:
+        if not args:
+            value = float(kind) / 1000
+            return lambda rnd: value
+
+        args = [float(arg) for arg in args.split(':')]
+        if kind == 'uniform':
+            low, high = args
+            return lambda rnd: rnd.uniform(low, high) / 1000
+        if kind == 'normal':
+            mean, deviation = args
+            return lambda rnd: max(0.0, rnd.gauss(mean, deviation)) / 1000
+        if kind == 'lognormal':
+            median, sigma = args
+            return lambda rnd: rnd.lognormvariate(math.log(median), sigma) / 1000
+        if kind == 'exp':
+            mean, = args
+            return lambda rnd: rnd.expovariate(1 / mean) / 1000
+    except ValueError:
+        pass
+
+    raise ValueError("bad latency distribution: {}".format(spec))
+
+
+def parse_settings(values):
+    """Normalizes a dict with SETTING_KEYS, as given on the command line or to /_fake/config."""
+    settings = {}
+
+    for key, value in values.items():
+        if key not in SETTING_KEYS:
+            raise ValueError("unknown setting: {}".format(key))
+        if key == 'latency':
+            parse_latency(value)
+        elif key == 'error_status':
+            value = [int(status) for status in str(value).split(',')] if not isinstance(value, list) else value
+        else:
+            value = float(value)
+        settings[key] = value
+
+    return settings
+
+
+def parse_endpoint(value):
+    path, _, options = value.partition(':')
+    return path, parse_settings(dict(option.split('=', 1) for option in options.split(',') if option))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def take(self):
+        """Takes a token; returns 0 on success or the seconds until the next token is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class FakeMedsenger:
+    def __init__(self, settings=None, endpoints=None, rate_limit=None, burst=None, records=0,
+                 record_interval=3600, keep=100000, log_file=None, seed=None):
+        self.settings = {"latency": 0, "error_rate": 0.0, "error_status": [500, 502, 503], "hang_rate": 0.0,
+                         "hang": 60.0}
+        self.settings.update(settings or {})
+        self.endpoints = dict(endpoints or {})
+        self.bucket = None
+        self.set_rate_limit(rate_limit, burst)
+
+        self.records_per_series = records
+        self.record_interval = record_interval
+        self.log_file = open(log_file, 'a') if log_file else None
+
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.received = deque(maxlen=keep)
+        self.counts = {}
+        self.latencies = {}
+        self.records = {}
+        self.tasks = {}
+        self.task_ids = 0
+        self.record_ids = 0
+
+    def set_rate_limit(self, rate, burst=None):
+        self.rate_limit = rate
+        self.bucket = TokenBucket(rate, burst or rate) if rate else None
+
+    def get_settings(self, path):
+        settings = dict(self.settings)
+        settings.update(self.endpoints.get(path, {}))
+        return settings
+
+    def configure(self, data):
+        with self.lock:
+            endpoints = data.pop('endpoints', {})
+            rate_limit = data.pop('rate_limit', self.rate_limit)
+            burst = data.pop('burst', None)
+
+            self.settings.update(parse_settings(data))
+            for path, values in endpoints.items():
+                self.endpoints.setdefault(path, {}).update(parse_settings(values))
+            if rate_limit != self.rate_limit or burst:
+                self.set_rate_limit(rate_limit, burst)
+
+    def reset(self):
+        with self.lock:
+            self.received.clear()
+            self.counts.clear()
+            self.latencies.clear()
+            self.records.clear()
+            self.tasks.clear()
+
+    def record(self, path, status, started, payload):
+        latency = time.perf_counter() - started
+        entry = {"time": time.time(), "path": path, "status": status, "latency_ms": round(latency * 1000, 3),
+                 "payload": payload}
+
+        with self.lock:
+            self.received.append(entry)
+            self.counts.setdefault(path, {})
+            self.counts[path][status] = self.counts[path].get(status, 0) + 1
+            self.latencies.setdefault(path, deque(maxlen=10000)).append(latency)
+
+            if self.log_file:
+                self.log_file.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+                self.log_file.flush()
+
+    def draw(self, settings):
+        """Decides the fate of one request: (delay in seconds, error status or None)."""
+        with self.lock:
+            delay = parse_latency(settings['latency'])(self.random)
+            roll = self.random.random()
+
+            if roll < settings['hang_rate']:
+                return settings['hang'], 504
+            if roll < settings['hang_rate'] + settings['error_rate']:
+                return delay, self.random.choice(settings['error_status'])
+            return delay, None
+
+    def get_series(self, contract_id, category_name):
+        """Records of a contract and category, oldest first; synthetic history is generated on first access."""
+        key = (contract_id, category_name)
+
+        with self.lock:
+            if key not in self.records:
+                seed = hashlib.md5('{}:{}'.format(contract_id, category_name).encode()).hexdigest()
+                rnd = random.Random(seed)
+                low, high = VALUE_RANGES.get(category_name, (0, 100))
+                now = int(time.time())
+                series = []
+
+                for i in range(self.records_per_series, 0, -1):
+                    self.record_ids += 1
+                    value = rnd.uniform(low, high)
+                    series.append(self.make_record(category_name, round(value, 1) if isinstance(low, float)
+                                                   else int(value), now - i * self.record_interval))
+
+                self.records[key] = series
+
+            return self.records[key]
+
+    def make_record(self, category_name, value, timestamp):
+        return {"id": self.record_ids, "category_name": category_name, "value": value, "timestamp": timestamp,
+                "date": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}
+
+    def add_records(self, contract_id, values):
+        for item in values:
+            series = self.get_series(contract_id, item['category_name'])
+
+            with self.lock:
+                self.record_ids += 1
+                series.append(self.make_record(item['category_name'], item['value'],
+                                               int(item.get('time') or time.time())))
+                series.sort(key=lambda record: (record['timestamp'], record['id']))
+
+    def query_records(self, data):
+        series = self.get_series(data.get('contract_id'), data.get('category_name'))
+        time_from = data.get('from')
+        time_to = data.get('to')
+
+        with self.lock:
+            values = [record for record in series
+                      if (time_from is None or record['timestamp'] >= float(time_from))
+                      and (time_to is None or record['timestamp'] <= float(time_to))]
+
+        offset = int(data.get('offset') or 0)
+        limit = data.get('limit')
+        values = values[offset:offset + int(limit)] if limit else values[offset:]
+
+        return {"category": data.get('category_name'), "values": values}
+
+    def add_task(self, data):
+        with self.lock:
+            self.task_ids += 1
+            self.tasks[self.task_ids] = {"contract_id": data.get('contract_id'), "number": data.get('number', 1),
+                                         "done": 0, "text": data.get('text')}
+            return {"task_id": self.task_ids}
+
+    def make_task(self, data):
+        with self.lock:
+            task = self.tasks.get(data.get('task_id'))
+            if task is None:
+                return None
+            task['done'] += 1
+            return {"is_done": task['done'] >= task['number']}
+
+    def delete_task(self, data):
+        with self.lock:
+            return {"deleted": self.tasks.pop(data.get('task_id'), None) is not None}
+
+    def stats(self):
+        with self.lock:
+            latencies = {path: sorted(values) for path, values in self.latencies.items()}
+            counts = {path: dict(statuses) for path, statuses in self.counts.items()}
+
+        def percentile(values, share):
+            return round(values[min(len(values) - 1, int(len(values) * share))] * 1000, 3)
+
+        return {path: {"statuses": counts[path], "requests": sum(counts[path].values()),
+                       "p50_ms": percentile(values, 0.5), "p95_ms": percentile(values, 0.95),
+                       "p99_ms": percentile(values, 0.99)}
+                for path, values in latencies.items() if values}
+
+
+def create_app(fake):
+    app = Flask(__name__)
+    app.config['JSON_AS_ASCII'] = False
+
+    handlers = {
+        '/api/agents/message': lambda data: {"state": "ok"},
+        '/api/agents/records/categories': lambda data: CATEGORIES,
+        '/api/agents/records/available_categories': lambda data: CATEGORIES,
+        '/api/agents/records/get': fake.query_records,
+        '/api/agents/records/add': lambda data: fake.add_records(data.get('contract_id'), data['values'] if 'values'
+                                                                 in data else [data]) or {"state": "ok"},
+        '/api/agents/tasks/add': fake.add_task,
+        '/api/agents/tasks/done': fake.make_task,
+        '/api/agents/tasks/delete': fake.delete_task,
+    }
+
+    def answer(path, started, payload, status, body=None, headers=None):
+        fake.record(path, status, started, payload)
+        return jsonify(body if body is not None else {"error": status}), status, headers or {}
+
+    @app.route('/api/agents/<path:name>', methods=['POST'])
+    def agents_api(name):
+        started = time.perf_counter()
+        path = request.path
+        payload = request.get_json(silent=True)
+
+        if path not in handlers:
+            return answer(path, started, payload, 404)
+        if payload is None:
+            return answer(path, started, payload, 400)
+
+        if fake.bucket:
+            wait = fake.bucket.take()
+            if wait:
+                return answer(path, started, payload, 429, headers={"Retry-After": str(math.ceil(wait))})
+
+        delay, error = fake.draw(fake.get_settings(path))
+        time.sleep(delay)
+        if error:
+            return answer(path, started, payload, error)
+
+        try:
+            body = handlers[path](payload)
+        except (KeyError, TypeError, ValueError):
+            return answer(path, started, payload, 422)
+
+        if body is None:
+            return answer(path, started, payload, 404)
+        return answer(path, started, payload, 200, body)
+
+    @app.route('/_fake/stats')
+    def fake_stats():
+        return jsonify(fake.stats())
+
+    @app.route('/_fake/requests')
+    def fake_requests():
+        path = request.args.get('path')
+        limit = request.args.get('limit', type=int)
+
+        with fake.lock:
+            entries = [entry for entry in fake.received if path is None or entry['path'] == path]
+
+        return jsonify(entries[-limit:] if limit else entries)
+
+    @app.route('/_fake/config', methods=['GET', 'POST'])
+    def fake_config():
+        if request.method == 'POST':
+            try:
+                fake.configure(dict(request.get_json(force=True)))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+        return jsonify({"settings": fake.settings, "endpoints": fake.endpoints, "rate_limit": fake.rate_limit})
+
+    @app.route('/_fake/reset', methods=['POST'])
+    def fake_reset():
+        fake.reset()
+        return jsonify({"state": "ok"})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--latency', default='0', help='latency distribution in ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with an error')
+    parser.add_argument('--error-status', default='500,502,503', help='error statuses to choose from')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='share of requests that hang for --hang seconds')
+    parser.add_argument('--hang', type=float, default=60.0)
+    parser.add_argument('--rate-limit', type=float, default=None, help='requests per second before answering 429')
+    parser.add_argument('--burst', type=int, default=None, help='token bucket size, defaults to --rate-limit')
+    parser.add_argument('--endpoint', action='append', type=parse_endpoint, default=[],
+                        help='PATH:key=value,... overrides for one endpoint, may be repeated')
+    parser.add_argument('--records', type=int, default=1000, help='synthetic records per contract and category')
+    parser.add_argument('--record-interval', type=int, default=3600, help='seconds between synthetic records')
+    parser.add_argument('--keep', type=int, default=100000, help='recorded requests kept in memory')
+    parser.add_argument('--log', default=None, help='also append every request to this NDJSON file')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    settings = parse_settings({"latency": args.latency, "error_rate": args.error_rate,
+                               "error_status": args.error_status, "hang_rate": args.hang_rate, "hang": args.hang})
+    fake = FakeMedsenger(settings, dict(args.endpoint), args.rate_limit, args.burst, args.records,
+                         args.record_interval, args.keep, args.log, args.seed)
+
+    create_app(fake).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
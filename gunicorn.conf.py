@@ -0,0 +1,26 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from config import *
+import config
+
+bind = '{}:{}'.format(HOST, PORT)
+workers = int(os.environ.get('WEB_WORKERS', getattr(config, 'WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1)))
+worker_class = 'sync'
+timeout = 30
+
+# Every worker imports the app itself, so each gets its own DB engine and caches; with preloading the
+# connection pool would be inherited across the fork.
+preload_app = False
+
+# A scrape reaches one arbitrary worker, so the workers publish their metrics to files here and /metrics
+# adds them up (metrics.share). The variable is inherited by the forked workers.
+metrics_dir = os.environ.setdefault('METRICS_MULTIPROC_DIR', getattr(
+    config, 'METRICS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'protocol-bot-metrics')))
+
+
+def on_starting(server):
+    # files of a previous run would be added to the new counters
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
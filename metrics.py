@@ -0,0 +1,247 @@
+import atexit
+import bisect
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+
+# set by share(): directory where every process of a pre-fork server publishes its values
+shared_directory = None
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self, values=None):
+        raise NotImplementedError
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values, other):
+        """Adds the values of another process; counters and histograms are summed."""
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values=None):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, key, extra, value in self.samples(values):
+            lines.append('{}{}{} {}'.format(self.name, suffix, format_labels(self.label_names, key, extra),
+                                            format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, values=None):
+        values = self.snapshot() if values is None else values
+        return [('_total', key, None, value) for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """Gauge set explicitly, or read from `callback` (returning {label tuple: value}) at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), callback=None):
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def snapshot(self):
+        if self.callback:
+            return dict(self.callback())
+        return super().snapshot()
+
+    def samples(self, values=None):
+        values = self.snapshot() if values is None else values
+        return [('', key, None, value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+    def merge(self, values, other):
+        for key, (counts, total) in other.items():
+            merged, merged_total = values.get(key, ([0] * len(counts), 0.0))
+            values[key] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+
+    def samples(self, values=None):
+        samples = []
+        values = self.snapshot() if values is None else values
+
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, [('le', format_value(bound))], cumulative))
+            samples.append(('_sum', key, None, total))
+            samples.append(('_count', key, None, cumulative))
+
+        return samples
+
+
+def snapshot_path(pid):
+    return os.path.join(shared_directory, '{}.json'.format(pid))
+
+
+def write_snapshot():
+    data = {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in registry}
+    path = snapshot_path(os.getpid())
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots():
+    """{pid: {metric name: values}} published by the other processes."""
+    snapshots = {}
+
+    for name in os.listdir(shared_directory):
+        pid, extension = os.path.splitext(name)
+        if extension != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+
+        try:
+            with open(os.path.join(shared_directory, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print('cant read metrics of process', pid, e)
+            continue
+
+        snapshots[int(pid)] = {metric: {tuple(key): value for key, value in values} for metric, values in data.items()}
+
+    return snapshots
+
+
+def share(directory, interval=5):
+    """Multiprocess mode for pre-fork servers, where a scrape reaches one arbitrary worker.
+
+    Every process writes its values to `directory` each `interval` seconds and on exit, and render() adds
+    up the files of all of them, so counters don't jump back whenever another worker answers. Files of
+    exited processes still count for counters and histograms, but not for gauges; the directory has to
+    be emptied when the server starts (see gunicorn.conf.py).
+    """
+    global shared_directory
+    shared_directory = directory
+
+    def publish():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot()
+            except OSError as e:
+                print('cant write metrics', e)
+
+    write_snapshot()
+    atexit.register(write_snapshot)
+    Thread(target=publish, name='metrics', daemon=True).start()
+
+
+def render():
+    if not shared_directory:
+        return '\n'.join(metric.render() for metric in registry) + '\n'
+
+    snapshots = read_snapshots()
+    lines = []
+
+    for metric in registry:
+        values = metric.snapshot()
+        for pid, data in snapshots.items():
+            if metric.kind == 'gauge' and not is_alive(pid):
+                continue
+            metric.merge(values, data.get(metric.name, {}))
+        lines.append(metric.render(values))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    """Serves render() on its own port from a daemon thread, for processes without a web app."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+agents_api_duration = Histogram('agents_api_request_duration_seconds', 'Medsenger agents API call latency.',
+                                ['endpoint'])
+agents_api_errors = Counter('agents_api_errors', 'Failed Medsenger agents API calls.', ['endpoint'])
@@ -1,22 +1,175 @@
+import hashlib
+import heapq
 import json
+import os
 import sys
 import time
+from functools import wraps
 from threading import Thread
-from flask import Flask, request, render_template, redirect
+from flask import Flask, Response, request, render_template, redirect, make_response, g, stream_with_context
 from datetime import datetime, timedelta
 from config import *
+import config
 import threading
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import Date, func, or_, and_, case, insert, create_engine, orm, inspect, text, bindparam, true
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from agents_api import *
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.security import generate_password_hash, check_password_hash
+from cache import LRUCache
+import query_stats
+import metrics
+from protocol_io import EVENT_FIELDS, InvalidImport, validate_protocol, dump_protocol, iter_ndjson, iter_json_array
+
+OUTBOX_BATCH_SIZE = getattr(config, 'OUTBOX_BATCH_SIZE', 50)
+OUTBOX_MAX_ATTEMPTS = getattr(config, 'OUTBOX_MAX_ATTEMPTS', 8)
+OUTBOX_RETRY_DELAY = getattr(config, 'OUTBOX_RETRY_DELAY', 30)
+OUTBOX_MAX_RETRY_DELAY = getattr(config, 'OUTBOX_MAX_RETRY_DELAY', 60 * 60)
+OUTBOX_POLL_INTERVAL = getattr(config, 'OUTBOX_POLL_INTERVAL', 10)
+OUTBOX_CLAIM_TIMEOUT = getattr(config, 'OUTBOX_CLAIM_TIMEOUT', 5 * 60)
+SENDER_LOCK_KEY = getattr(config, 'SENDER_LOCK_KEY', 0x70726f74)
+SCHEDULER_MAX_SLEEP = getattr(config, 'SCHEDULER_MAX_SLEEP', 60 * 60)
+SCHEDULER_RETRY_DELAY = getattr(config, 'SCHEDULER_RETRY_DELAY', 60)
+SCHEDULER_POLL_INTERVAL = getattr(config, 'SCHEDULER_POLL_INTERVAL', 30)
+SCHEDULER_METRICS_PORT = getattr(config, 'SCHEDULER_METRICS_PORT', 9101)
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR')
+METRICS_SHARE_INTERVAL = getattr(config, 'METRICS_SHARE_INTERVAL', 5)
+STATUS_CACHE_SIZE = getattr(config, 'STATUS_CACHE_SIZE', 1024)
+PAGE_CACHE_SIZE = getattr(config, 'PAGE_CACHE_SIZE', 512)
+IMPORT_BATCH_SIZE = getattr(config, 'IMPORT_BATCH_SIZE', 1000)
+EXPORT_BATCH_SIZE = getattr(config, 'EXPORT_BATCH_SIZE', 500)
+DIGEST_MODE = getattr(config, 'DIGEST_MODE', False)
+DIGEST_MIN_EVENTS = getattr(config, 'DIGEST_MIN_EVENTS', 2)
+DB_POOL_SIZE = getattr(config, 'DB_POOL_SIZE', 10)
+DB_MAX_OVERFLOW = getattr(config, 'DB_MAX_OVERFLOW', 20)
+DB_POOL_TIMEOUT = getattr(config, 'DB_POOL_TIMEOUT', 10)
+DB_POOL_RECYCLE = getattr(config, 'DB_POOL_RECYCLE', 30 * 60)
+DB_POOL_PRE_PING = getattr(config, 'DB_POOL_PRE_PING', True)
+DB_STATEMENT_TIMEOUT = getattr(config, 'DB_STATEMENT_TIMEOUT', 30)
+DB_READ_STATEMENT_TIMEOUT = getattr(config, 'DB_READ_STATEMENT_TIMEOUT', 10)
+DB_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL', getattr(config, 'DB_REPLICA_URL', None))
+SLOW_QUERY_THRESHOLD = getattr(config, 'SLOW_QUERY_THRESHOLD', 0.1)
+QUERY_BUDGET_STRICT = getattr(config, 'QUERY_BUDGET_STRICT', False)
+QUERY_BUDGETS = getattr(config, 'QUERY_BUDGETS', {
+    'status': 3,
+    'actions': 3,
+    'settings': 6,
+    'setting_save': 8,
+    'protocol_page': 8,
+    'save_event': 16,
+    'save_event_page': 12,
+    'digest_page': 4,
+    'save_digest': 6,
+})
+
+
+def get_engine_options(url, statement_timeout, read_only=False):
+    """Pool and timeout settings for create_engine; SQLite keeps its default pool and has no statement timeout."""
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+
+    if url.startswith('sqlite'):
+        return options
+
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                   pool_recycle=DB_POOL_RECYCLE)
+
+    if url.startswith('postgres'):
+        settings = ['-c statement_timeout={}'.format(int(statement_timeout * 1000))] if statement_timeout else []
+        if read_only:
+            settings.append('-c default_transaction_read_only=on')
+        if settings:
+            options['connect_args'] = {'options': ' '.join(settings)}
+
+    return options
+
+
+_routing = threading.local()
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of @read_only views to the replica engine, when one is configured.
+
+    Flushes always go to the primary, so an unexpected write in a read-only view fails loudly there instead
+    of on the replica.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if replica_engine is not None and getattr(_routing, 'read_only', False) and not self._flushing:
+            return replica_engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(f):
+    """Marks a view that only reads, so its queries may be served by DB_REPLICA_URL.
+
+    The replica can lag behind the primary; views marked this way key their caches and ETags by the data
+    versions they read, so a lagging replica serves an older but consistent page.
+    """
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        previous = getattr(_routing, 'read_only', False)
+        _routing.read_only = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _routing.read_only = previous
+
+    return decorated
+
 
 app = Flask(__name__)
-db_string = "postgres://{}:{}@{}:{}/{}".format(DB_LOGIN, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE)
-app.config['SQLALCHEMY_DATABASE_URI'] = db_string
-db = SQLAlchemy(app)
+db_string = "postgresql://{}:{}@{}:{}/{}".format(DB_LOGIN, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', db_string)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app.config['SQLALCHEMY_DATABASE_URI'],
+                                                             DB_STATEMENT_TIMEOUT)
+db = RoutingSQLAlchemy(app)
 auth = HTTPBasicAuth()
 
+replica_engine = None
+if DB_REPLICA_URL:
+    replica_engine = create_engine(DB_REPLICA_URL, **get_engine_options(DB_REPLICA_URL, DB_READ_STATEMENT_TIMEOUT,
+                                                                        read_only=True))
+
+query_stats.configure(SLOW_QUERY_THRESHOLD, QUERY_BUDGETS, QUERY_BUDGET_STRICT)
+query_stats.install(db.engine)
+if replica_engine is not None:
+    query_stats.install(replica_engine)
+
+
+def get_pool_usage():
+    usage = {}
+
+    for name, engine in [('primary', db.engine), ('replica', replica_engine)]:
+        if engine is None:
+            continue
+
+        for state, method in [('checked_out', 'checkedout'), ('checked_in', 'checkedin'),
+                              ('overflow', 'overflow'), ('size', 'size')]:
+            if hasattr(engine.pool, method):
+                usage[(name, state)] = getattr(engine.pool, method)()
+
+    return usage
+
+
+request_duration = metrics.Histogram('http_request_duration_seconds', 'Request latency by route.',
+                                     ['route', 'method', 'status'])
+send_iteration_duration = metrics.Histogram('send_iteration_duration_seconds', 'Duration of a scheduler pass.')
+send_iteration_contracts = metrics.Gauge('send_iteration_contracts', 'Contracts with due events in the last pass.')
+send_iteration_events = metrics.Gauge('send_iteration_events', 'Due events found by the last pass.')
+notifications = metrics.Counter('notifications', 'Outbound notifications by role and delivery result.',
+                                ['role', 'result'])
+db_pool = metrics.Gauge('db_pool_connections', 'Database connection pool usage.', ['engine', 'state'],
+                        callback=get_pool_usage)
+
 users = {
     ADMIN_LOGIN: generate_password_hash(ADMIN_PASSWORD),
 }
@@ -28,12 +181,35 @@ def verify_password(username, password):
         return username
 
 
+class date_add_days(FunctionElement):
+    """SQL expression for `date + days`, so date arithmetic stays in the database."""
+    type = Date()
+    name = 'date_add_days'
+    inherit_cache = True
+
+
+@compiles(date_add_days)
+def compile_date_add_days(element, compiler, **kw):
+    date, days = list(element.clauses)
+    return "({} + {})".format(compiler.process(date, **kw), compiler.process(days, **kw))
+
+
+@compiles(date_add_days, 'sqlite')
+def compile_date_add_days_sqlite(element, compiler, **kw):
+    date, days = list(element.clauses)
+    # a NULL day count has to give NULL like on Postgres; printf() would turn it into '+0 days'
+    return "date({}, {} || ' days')".format(compiler.process(date, **kw), compiler.process(days, **kw))
+
+
 class Contract(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     active = db.Column(db.Boolean, default=True)
     protocols = db.relationship('Protocol', secondary='contract_protocols')
     events = db.relationship('Event', secondary='event_results')
 
+    # the scheduler and /status only ever look at active contracts
+    __table_args__ = (db.Index('ix_contract_active', id, postgresql_where=active == True, sqlite_where=active == True),)
+
 
 class Protocol(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -48,7 +224,7 @@ class Protocol(db.Model):
 
 class ContractProtocols(db.Model):
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
-    protocol_id = db.Column(db.Integer, db.ForeignKey('protocol.id'), primary_key=True)
+    protocol_id = db.Column(db.Integer, db.ForeignKey('protocol.id'), primary_key=True, index=True)
     start = db.Column(db.Date, nullable=True)
 
     def get_event_start_date(self, event):
@@ -76,7 +252,7 @@ class ContractProtocols(db.Model):
 
 class EventResults(db.Model):
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
-    event_id = db.Column(db.Integer, db.ForeignKey('event.id'), primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id'), primary_key=True, index=True)
 
     patient_confirmation = db.Column(db.Date, nullable=True)
     doctor_confirmation = db.Column(db.Date, nullable=True)
@@ -122,17 +298,22 @@ class Event(db.Model):
     need_comment_patient = db.Column(db.Boolean, default=False)
 
     protocol_id = db.Column(db.Integer, db.ForeignKey('protocol.id'),
-                            nullable=False)
+                            nullable=False, index=True)
+
+    def get_period_text(self, protocol: ContractProtocols):
+        start = protocol.start + timedelta(days=self.start_day)
+
+        if self.end_day is None:
+            return "Планируемый срок выполения - с <b>{}</b>".format(start)
+
+        return "Планируемый срок выполения - с <b>{}</b> по <b>{}</b>".format(
+            start, protocol.start + timedelta(days=self.end_day))
 
     def get_patient_message(self, protocol: ContractProtocols):
         text = self.patient_description
         title = self.patient_title
 
-        message = "<b>{}</b><br><br>{}<br><br><small>Планируемый срок выполения - с <b>{}</b> по <b>{}</b></small>".format(
-            title, text, protocol.start + timedelta(days=self.start_day),
-                         protocol.start + timedelta(days=self.end_day))
-
-        return message
+        return "<b>{}</b><br><br>{}<br><br><small>{}</small>".format(title, text, self.get_period_text(protocol))
 
     def get_doctor_message(self, protocol: ContractProtocols):
         if self.doctor_title:
@@ -145,11 +326,7 @@ class Event(db.Model):
         else:
             text = self.patient_description
 
-        message = "<b>{}</b><br><br>{}<br><br><small>Планируемый срок выполения - с <b>{}</b> по <b>{}</b></small>".format(
-            title, text, protocol.start + timedelta(days=self.start_day),
-                         protocol.start + timedelta(days=self.end_day))
-
-        return message
+        return "<b>{}</b><br><br>{}<br><br><small>{}</small>".format(title, text, self.get_period_text(protocol))
 
     def get_doctor_title(self):
         if self.doctor_title:
@@ -160,10 +337,194 @@ class Event(db.Model):
         return title
 
 
-try:
+class OutboxMessage(db.Model):
+    """Outbound Medsenger message, written in the same transaction as the state change that caused it."""
+    id = db.Column(db.Integer, primary_key=True)
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'))
+    event_id = db.Column(db.Integer, nullable=True, index=True)
+    message = db.Column(db.Text)
+
+    status = db.Column(db.String(16), default='pending')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, default=datetime.now)
+    last_error = db.Column(db.Text, nullable=True)
+
+    created = db.Column(db.DateTime, default=datetime.now)
+    sent = db.Column(db.DateTime, nullable=True)
+
+    # status is compared with a bound parameter, which a partial index predicate can't be matched against;
+    # the index also yields claim order, so the dispatcher never sorts the backlog
+    __table_args__ = (db.Index('ix_outbox_message_status_next_attempt', status, next_attempt, id),)
+
+
+class DataVersion(db.Model):
+    """Change counter per contract or protocol.
+
+    Write paths bump it in the same transaction as the change; caches include it in their keys, so every
+    process sees a committed change on its next lookup.
+    """
+    kind = db.Column(db.String(32), primary_key=True)
+    key = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+
+
+class ContractEventSchedule(db.Model):
+    """Absolute dates of every event for every attached contract, materialized from ContractProtocols.start.
+
+    notify_date follows notification_day regardless of the notify flags, the same rule send_iteration uses
+    to create EventResults; end_date is empty when the event has no end_day, like get_event_end_date.
+    """
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id'), primary_key=True)
+    protocol_id = db.Column(db.Integer, db.ForeignKey('protocol.id'), index=True)
+
+    notify_date = db.Column(db.Date, nullable=True, index=True)
+    start_date = db.Column(db.Date, nullable=True, index=True)
+    end_date = db.Column(db.Date, nullable=True, index=True)
+
+
+def refresh_event_schedule(contract_id=None, protocol_id=None, event_id=None):
+    """Recomputes schedule rows matching the given filters with one DELETE and one INSERT ... SELECT.
+
+    The INSERT is an upsert: an overlapping refresh of the same rows (a double-submitted form, settings saved
+    while the event is edited) may commit rows this transaction's DELETE didn't see.
+    """
+    db.session.flush()
+
+    stale = ContractEventSchedule.query
+    rows = db.session.query(ContractProtocols.contract_id, Event.id, Event.protocol_id,
+                            date_add_days(ContractProtocols.start, Event.notification_day),
+                            date_add_days(ContractProtocols.start, Event.start_day),
+                            case((Event.end_day == 0, None),
+                                 else_=date_add_days(ContractProtocols.start, Event.end_day))) \
+        .join(Event, Event.protocol_id == ContractProtocols.protocol_id)
+
+    if contract_id is not None:
+        stale = stale.filter(ContractEventSchedule.contract_id == contract_id)
+        rows = rows.filter(ContractProtocols.contract_id == contract_id)
+    if protocol_id is not None:
+        stale = stale.filter(ContractEventSchedule.protocol_id == protocol_id)
+        rows = rows.filter(ContractProtocols.protocol_id == protocol_id)
+    if event_id is not None:
+        stale = stale.filter(ContractEventSchedule.event_id == event_id)
+        rows = rows.filter(Event.id == event_id)
+
+    stale.delete(synchronize_session=False)
+
+    # SQLite needs a WHERE before ON CONFLICT in INSERT ... SELECT, or it parses the ON as part of the join
+    refresh = dialect_insert(ContractEventSchedule).from_select(
+        ['contract_id', 'event_id', 'protocol_id', 'notify_date', 'start_date', 'end_date'], rows.filter(true()))
+    db.session.execute(refresh.on_conflict_do_update(
+        index_elements=['contract_id', 'event_id'],
+        set_={name: refresh.excluded[name] for name in ['protocol_id', 'notify_date', 'start_date', 'end_date']}))
+
+
+def ensure_event_schedule():
+    """Fills the schedule table the first time it is deployed next to existing attachments."""
+    if not ContractEventSchedule.query.first() and ContractProtocols.query.first():
+        refresh_event_schedule()
+        db.session.commit()
+
+
+def ensure_indexes():
+    """create_all only builds indexes for new tables; this adds indexes declared later to existing ones."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+
+def ensure_columns():
+    """create_all doesn't alter existing tables; this adds nullable columns declared later."""
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                db.session.execute(db.text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    preparer.format_table(table), preparer.format_column(column),
+                    column.type.compile(dialect=db.engine.dialect))))
+
+    db.session.commit()
+
+
+def init_db():
+    """Creates and upgrades the schema; run once per deploy (`migrate` or the scheduler), not by web workers."""
     db.create_all()
-except:
-    print('cant create structure')
+    ensure_columns()
+    ensure_indexes()
+    ensure_event_schedule()
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def dialect_insert(model):
+    """INSERT construct with ON CONFLICT support for the configured database."""
+    if is_postgres():
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def bump_version(kind, key):
+    bump_versions(kind, [key])
+
+
+def bump_versions(kind, keys):
+    """Increments the versions of many keys of one kind with a single multi-row upsert."""
+    if not keys:
+        return
+
+    # a fixed order keeps concurrent bumps of overlapping keys from deadlocking
+    bump = dialect_insert(DataVersion).values([{'kind': kind, 'key': key, 'version': 1} for key in sorted(keys)])
+    db.session.execute(bump.on_conflict_do_update(index_elements=['kind', 'key'],
+                                                  set_={'version': DataVersion.version + 1}))
+
+
+def get_versions(*pairs):
+    """Current versions for (kind, key) pairs in one query, in the same order; 0 if never bumped."""
+    rows = db.session.query(DataVersion.kind, DataVersion.key, DataVersion.version) \
+        .filter(or_(*[and_(DataVersion.kind == kind, DataVersion.key == key) for kind, key in pairs])).all()
+    versions = {(kind, key): version for kind, key, version in rows}
+    return tuple(versions.get(pair, 0) for pair in pairs)
+
+
+def get_templates_version():
+    """Digest of the template sources, so a deploy with changed templates never matches an old validator."""
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(os.path.join(app.root_path, app.template_folder))):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+templates_version = get_templates_version()
+page_cache = LRUCache(PAGE_CACHE_SIZE)
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr((templates_version,) + parts).encode()).hexdigest()
+
+
+def is_not_modified(etag):
+    return request.method == 'GET' and etag in request.if_none_match
+
+
+def not_modified(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    return response
+
+
+def page_response(body, etag):
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 def filter_empty_string(string):
@@ -209,23 +570,96 @@ def validate_date(date):
         return False
 
 
+def parse_date(date):
+    try:
+        return datetime.strptime(date, '%Y-%m-%d').date()
+    except:
+        return None
+
+
+class TrackedContracts:
+    """Active contract ids reported by /status, kept in memory together with the encoded answer.
+
+    The set is loaded once and then follows /init and /remove incrementally. Each of them bumps the
+    ('contracts', 0) version; a poll that sees a version this process has not applied reloads the set,
+    so changes made by other processes are picked up too.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.version = None
+        self.answer = None
+        self.lock = threading.Lock()
+
+    def update(self, contract_id, active, version):
+        with self.lock:
+            if self.version is None or version != self.version + 1:
+                self.version = None
+                return
+
+            if active:
+                self.ids.add(contract_id)
+            else:
+                self.ids.discard(contract_id)
+
+            self.version = version
+            self.answer = None
+
+    def get_answer(self):
+        version = get_versions(('contracts', 0))[0]
+
+        with self.lock:
+            if version != self.version:
+                self.ids = {row[0] for row in db.session.query(Contract.id).filter(Contract.active == True)}
+                self.version = version
+                self.answer = None
+
+            if self.answer is None:
+                self.answer = '{"is_tracking_data": true, "supported_scenarios": [], "tracked_contracts": [%s]}' % \
+                              ', '.join(map(str, sorted(self.ids)))
+
+            return self.answer
+
+
+tracked_contracts = TrackedContracts()
+
+
+@app.before_request
+def start_query_stats():
+    g.query_stats = query_stats.start(request.endpoint)
+
+
+@app.after_request
+def stop_query_stats(response):
+    if query_stats.current() is g.get('query_stats'):
+        stats = query_stats.stop()
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time'] = '{:.1f}'.format(stats.duration * 1000)
+        request_duration.observe(stats.elapsed, route=request.url_rule.rule if request.url_rule else '-',
+                                 method=request.method, status=response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+@app.teardown_request
+def drop_query_stats(exception):
+    if g.get('query_stats') and query_stats.current() is g.query_stats:
+        query_stats.stop()
+
+
 @app.route('/status', methods=['POST'])
+@read_only
 def status():
     data = request.json
 
     if data['api_key'] != APP_KEY:
         return 'invalid key'
 
-    contract_ids = [l[0] for l in db.session.query(Contract.id).all()]
-
-    answer = {
-        "is_tracking_data": True,
-        "supported_scenarios": [],
-        "tracked_contracts": contract_ids
-    }
-    print(answer)
-
-    return json.dumps(answer)
+    return tracked_contracts.get_answer()
 
 
 @app.route('/init', methods=['POST'])
@@ -250,7 +684,12 @@ def init():
 
             print("{}: Add contract {}".format(gts(), contract.id))
 
+        bump_version('contracts', 0)
+        schedule_changed()
+        version = get_versions(('contracts', 0))[0]
         db.session.commit()
+        tracked_contracts.update(contract_id, True, version)
+        invalidate_categories(contract_id)
 
 
     except Exception as e:
@@ -258,11 +697,36 @@ def init():
         return "error"
 
     print('sending ok')
-    delayed(1, send_iteration, [])
+    schedule.invalidate()
     return 'ok'
 
 
+def get_actions(contract_id):
+    actions = []
+    protocols = db.session.query(Protocol.id, Protocol.title) \
+        .join(ContractProtocols, ContractProtocols.protocol_id == Protocol.id) \
+        .filter(ContractProtocols.contract_id == contract_id).all()
+
+    for protocol_id, title in protocols:
+        actions.append({
+            "name": 'Протокол "{}"'.format(title),
+            "link": "/protocol/{}/doctor".format(protocol_id),
+            "type": "doctor"
+        })
+        actions.append({
+            "name": 'Протокол "{}"'.format(title),
+            "link": "/protocol/{}/patient".format(protocol_id),
+            "type": "patient"
+        })
+
+    return actions
+
+
+actions_cache = LRUCache(STATUS_CACHE_SIZE)
+
+
 @app.route('/actions', methods=['POST'])
+@read_only
 def actions():
     data = request.json
 
@@ -270,28 +734,16 @@ def actions():
         print('invalid key')
         return 'invalid key'
 
-    actions = []
-
     try:
-        contract_id = str(data['contract_id'])
-        query = Contract.query.filter_by(id=contract_id)
+        contract_id = int(data['contract_id'])
+        key = (contract_id,) + get_versions(('contract', contract_id), ('catalog', 0))
 
-        if query.count() != 0:
-            contract = query.first()
+        answer = actions_cache.get(key)
+        if answer is None:
+            answer = json.dumps(get_actions(contract_id))
+            actions_cache.set(key, answer)
 
-            for protocol in contract.protocols:
-                actions.append({
-                    "name": 'Протокол "{}"'.format(protocol.title),
-                    "link": "/protocol/{}/doctor".format(protocol.id),
-                    "type": "doctor"
-                })
-                actions.append({
-                    "name": 'Протокол "{}"'.format(protocol.title),
-                    "link": "/protocol/{}/patient".format(protocol.id),
-                    "type": "patient"
-                })
-
-        return json.dumps(actions)
+        return answer
 
     except Exception as e:
         print(e)
@@ -314,9 +766,15 @@ def remove():
             contract = query.first()
             contract.active = False
 
+            bump_version('contracts', 0)
+            schedule_changed()
+            version = get_versions(('contracts', 0))[0]
             db.session.commit()
+            tracked_contracts.update(contract.id, False, version)
+            invalidate_categories(contract.id)
 
             print("{}: Deactivate contract {}".format(gts(), contract.id))
+            schedule.invalidate()
         else:
             print('contract not found')
 
@@ -328,17 +786,27 @@ def remove():
 
 
 @app.route('/settings', methods=['GET'])
+@read_only
 def settings():
     key = request.args.get('api_key', '')
 
     if key != APP_KEY:
         return "<strong>Некорректный ключ доступа.</strong> Свяжитесь с технической поддержкой."
 
-    protocols = Protocol.query.all()
     connections = {}
 
     try:
         contract_id = int(request.args.get('contract_id'))
+        etag = make_etag('settings', contract_id, *get_versions(('contract', contract_id), ('catalog', 0)))
+
+        if is_not_modified(etag):
+            return not_modified(etag)
+
+        body = page_cache.get(etag)
+        if body:
+            return page_response(body, etag)
+
+        protocols = Protocol.query.all()
         query = Contract.query.filter_by(id=contract_id)
         if query.count() != 0:
             contract = query.first()
@@ -353,7 +821,33 @@ def settings():
         print(e)
         return "error"
 
-    return render_template('settings.html', contract=contract, protocols=protocols, connections=connections)
+    body = render_template('settings.html', contract=contract, protocols=protocols, connections=connections)
+    page_cache.set(etag, body)
+    return page_response(body, etag)
+
+
+def diff_contract_protocols(contract_id, form):
+    """Compares the settings form with the current attachments in one query.
+
+    Returns rows to upsert (new attachments, and existing ones with a valid new start date)
+    and the ids of protocols to detach.
+    """
+    catalog = db.session.query(Protocol.id, ContractProtocols.protocol_id) \
+        .outerjoin(ContractProtocols, and_(ContractProtocols.protocol_id == Protocol.id,
+                                           ContractProtocols.contract_id == contract_id)).all()
+    upserts = []
+    removed = []
+
+    for protocol_id, attached in catalog:
+        if form.get('protocol_{}'.format(protocol_id), None) == 'on':
+            start = parse_date(form.get('protocol_{}_date'.format(protocol_id)))
+
+            if not attached or start:
+                upserts.append({"contract_id": contract_id, "protocol_id": protocol_id, "start": start})
+        elif attached:
+            removed.append(protocol_id)
+
+    return upserts, removed
 
 
 @app.route('/settings', methods=['POST'])
@@ -365,31 +859,26 @@ def setting_save():
 
     try:
         contract_id = int(request.args.get('contract_id'))
-        query = Contract.query.filter_by(id=contract_id)
-        if query.count() != 0:
-            contract = query.first()
-            protocols = Protocol.query.all()
-
-            for protocol in protocols:
-                if request.form.get('protocol_{}'.format(protocol.id), None) == 'on':
-                    if protocol in contract.protocols and validate_date(
-                            request.form.get('protocol_{}_date'.format(protocol.id))):
-                        connection = ContractProtocols.query.filter_by(contract_id=contract_id,
-                                                                       protocol_id=protocol.id).first()
-                        connection.start = request.form.get('protocol_{}_date'.format(protocol.id))
-                        db.session.add(connection)
-
-                    elif protocol not in contract.protocols:
-                        connection = ContractProtocols(contract_id=contract_id, protocol_id=protocol.id)
-                        if validate_date(request.form.get('protocol_{}_date'.format(protocol.id))):
-                            connection.start = request.form.get('protocol_{}_date'.format(protocol.id))
-
-                        db.session.add(connection)
-                else:
-                    if protocol in contract.protocols:
-                        ContractProtocols.query.filter_by(contract_id=contract_id, protocol_id=protocol.id).delete()
+
+        if Contract.query.get(contract_id):
+            upserts, removed = diff_contract_protocols(contract_id, request.form)
+
+            if upserts:
+                upsert = dialect_insert(ContractProtocols).values(upserts)
+                db.session.execute(upsert.on_conflict_do_update(index_elements=['contract_id', 'protocol_id'],
+                                                                set_={'start': upsert.excluded.start}))
+            if removed:
+                ContractProtocols.query.filter(ContractProtocols.contract_id == contract_id,
+                                               ContractProtocols.protocol_id.in_(removed)) \
+                    .delete(synchronize_session=False)
+
+            if upserts or removed:
+                refresh_event_schedule(contract_id=contract_id)
+                bump_version('contract', contract_id)
+                schedule_changed()
 
             db.session.commit()
+            schedule.invalidate()
         else:
             return "<strong>Ошибка. Контракт не найден.</strong> Попробуйте отключить и снова подключить интеллектуальный агент к каналу консультирвоания.  Если это не сработает, свяжитесь с технической поддержкой."
 
@@ -440,18 +929,189 @@ def save_event_page(role, event_id):
             if role == 'patient':
                 result.patient_confirmation = datetime.today().date()
                 result.patient_confirmation_filled = datetime.today().date()
+            bump_version('contract', contract_id)
             db.session.commit()
 
             return "<strong>Спасибо, окно можно закрыть</strong><script>window.parent.postMessage('close-modal-success','*');</script>"
 
-        return render_template('event.html', contract=contract, event=event)
+        etag = make_etag('event', role, contract_id, event_id,
+                         *get_versions(('contract', contract_id), ('protocol', event.protocol_id)))
+
+        if is_not_modified(etag):
+            return not_modified(etag)
+
+        body = page_cache.get(etag)
+        if not body:
+            body = render_template('event.html', contract=contract, event=event)
+            page_cache.set(etag, body)
+
+        return page_response(body, etag)
 
     except:
         return "error"
 
 
+def get_digest_events(contract_id, role, day):
+    """(event, result) pairs notified to the role on the given day, in the order of the digest message."""
+    return db.session.query(Event, EventResults) \
+        .select_from(ContractEventSchedule) \
+        .join(Event, Event.id == ContractEventSchedule.event_id) \
+        .outerjoin(EventResults, and_(EventResults.contract_id == ContractEventSchedule.contract_id,
+                                      EventResults.event_id == ContractEventSchedule.event_id)) \
+        .filter(ContractEventSchedule.contract_id == contract_id, ContractEventSchedule.notify_date == day,
+                getattr(Event, 'notify_' + role) == True) \
+        .order_by(Event.protocol_id, Event.id).all()
+
+
+@app.route('/<role>/digest/<day>', methods=['GET'])
+@read_only
+def digest_page(role, day):
+    key = request.args.get('api_key', '')
+
+    if key != APP_KEY:
+        return "<strong>Некорректный ключ доступа.</strong> Свяжитесь с технической поддержкой."
+
+    try:
+        contract_id = int(request.args.get('contract_id', ''))
+        day = parse_date(day)
+
+        if role not in ['doctor', 'patient'] or not day:
+            return "error"
+
+        events = get_digest_events(contract_id, role, day)
+        return render_template('digest.html', role=role, events=events, key=key, contract_id=contract_id)
+
+    except Exception as e:
+        print(e)
+        return "error"
+
+
+@app.route('/<role>/digest/<day>', methods=['POST'])
+def save_digest(role, day):
+    key = request.args.get('api_key', '')
+
+    if key != APP_KEY:
+        return "<strong>Некорректный ключ доступа.</strong> Свяжитесь с технической поддержкой."
+
+    try:
+        contract_id = int(request.args.get('contract_id', ''))
+        day = parse_date(day)
+
+        if role not in ['doctor', 'patient'] or not day:
+            return "error"
+
+        today = datetime.today().date()
+        # events that need a comment are confirmed one by one through save_event, never from the digest
+        confirmed = [event.id for event, result in get_digest_events(contract_id, role, day)
+                     if result and getattr(event, 'need_confirmation_' + role)
+                     and not getattr(event, 'need_comment_' + role)
+                     and request.form.get('event_{}'.format(event.id)) == 'on']
+
+        if confirmed:
+            EventResults.query.filter(EventResults.contract_id == contract_id,
+                                      EventResults.event_id.in_(confirmed)) \
+                .update({role + '_confirmation': today, role + '_confirmation_filled': today},
+                        synchronize_session=False)
+            bump_version('contract', contract_id)
+            db.session.commit()
+
+        return "<strong>Спасибо, окно можно закрыть</strong><script>window.parent.postMessage('close-modal-success','*');</script>"
+
+    except Exception as e:
+        print(e)
+        return "error"
+
+
+def get_event_status(event, result, connection, today):
+    """Status of one event for a contract; optional events get an `_additional` suffix."""
+    if not result:
+        if today < connection.get_event_start_date(event):
+            return 'pre'
+        return 'progress'
+
+    end_date = connection.get_event_end_date(event)
+    suffix = '' if event.is_required else '_additional'
+
+    if (not event.need_confirmation_doctor or result.doctor_confirmation) and (
+            not event.need_confirmation_patient or result.patient_confirmation):
+        if (not result.doctor_confirmation or result.doctor_confirmation < end_date) and \
+                (not result.patient_confirmation or result.patient_confirmation < end_date):
+            return 'done' + suffix
+        return 'delayed' + suffix
+
+    if not event.need_confirmation_doctor and not event.need_confirmation_patient:
+        return 'pass'
+
+    if today < end_date:
+        return 'progress' + suffix
+    return 'fail' + suffix
+
+
+def get_protocol_stats(events, event_status):
+    stats = {"total": 0, "additional_total": 0, "done": 0, "failed": 0, "delayed": 0}
+    counters = {'done': 'done', 'fail': 'failed', 'delayed': 'delayed'}
+
+    for event in events:
+        stats['total' if event.is_required else 'additional_total'] += 1
+
+        status = event_status.get(event.id)
+        if status in counters:
+            stats[counters[status]] += 1
+
+    return stats
+
+
+def get_protocol_context(contract_id, protocol_id, today):
+    """Template context for the protocol pages, loaded with a fixed number of queries."""
+    protocol = Protocol.query.get(protocol_id)
+    connection = ContractProtocols.query.get((contract_id, protocol_id))
+    events = Event.query.filter_by(protocol_id=protocol_id).all()
+
+    event_results = {result.event_id: result for result in
+                     EventResults.query.join(Event).filter(EventResults.contract_id == contract_id,
+                                                           Event.protocol_id == protocol_id)}
+    event_periods = {}
+    event_notifications = {}
+    event_status = {}
+
+    for event in events:
+        S = connection.get_formatted_event_start_date(event)
+        E = connection.get_formatted_event_end_date(event)
+
+        if E:
+            event_periods[event.id] = "{} - {}".format(S, E)
+        else:
+            event_periods[event.id] = S
+
+        event_notifications[event.id] = connection.get_formatted_notification_date(event)
+        event_status[event.id] = get_event_status(event, event_results.get(event.id), connection, today)
+
+    db.session.expunge(protocol)
+    for obj in events + list(event_results.values()):
+        db.session.expunge(obj)
+
+    return {
+        "events": events,
+        "event_results": event_results,
+        "protocol": protocol,
+        "event_periods": event_periods,
+        "event_notifications": event_notifications,
+        "event_status": event_status,
+        "stats": get_protocol_stats(events, event_status)
+    }
+
+
+protocol_cache = LRUCache(STATUS_CACHE_SIZE)
+
+
 @app.route('/protocol/<protocol_id>/<client>', methods=['GET'])
+@read_only
 def protocol_page(protocol_id, client):
+    return render_protocol_page(protocol_id, client)
+
+
+def render_protocol_page(protocol_id, client):
+    """Body of protocol_page; save_event calls it directly so the page it returns is read from the primary."""
     key = request.args.get('api_key', '')
 
     if key != APP_KEY:
@@ -462,88 +1122,32 @@ def protocol_page(protocol_id, client):
         contract_id = int(request.args.get('contract_id', ''))
         protocol_id = int(protocol_id)
 
-        contract_query = Contract.query.filter_by(id=contract_id)
-        events = Event.query.filter_by(protocol_id=protocol_id).all()
+        key = (contract_id, protocol_id, today) + get_versions(('contract', contract_id), ('protocol', protocol_id))
+        etag = make_etag('protocol', client, *key)
 
-        if contract_query.count() == 0:
-            return "<strong>Запрашиваемый канал консультирования не найден.</strong> Попробуйте отключить и заного подключить интеллектуального агента. Если это не сработает, свяжитесь с технической поддержкой."
-
-        event_results = {}
-        event_periods = {}
-        event_notifications = {}
-        event_status = {}
+        if is_not_modified(etag):
+            return not_modified(etag)
 
-        protocol = Protocol.query.get(protocol_id)
-        contract = Contract.query.get(contract_id)
+        body = page_cache.get(etag)
+        if body:
+            return page_response(body, etag)
 
-        for event in events:
-            result_query = EventResults.query.filter_by(event_id=event.id, contract_id=contract_id)
+        context = protocol_cache.get(key)
 
-            if result_query.count():
-                event_results[event.id] = result_query.first()
+        if not context:
+            if not Contract.query.get(contract_id):
+                return "<strong>Запрашиваемый канал консультирования не найден.</strong> Попробуйте отключить и заного подключить интеллектуального агента. Если это не сработает, свяжитесь с технической поддержкой."
 
-            connection = protocol.get_connection(contract)
-            S = connection.get_formatted_event_start_date(event)
-            E = connection.get_formatted_event_end_date(event)
+            context = get_protocol_context(contract_id, protocol_id, today)
+            protocol_cache.set(key, context)
 
-            if E:
-                event_periods[event.id] = "{} - {}".format(S, E)
-            else:
-                event_periods[event.id] = S
-
-            event_notifications[event.id] = connection.get_formatted_notification_date(event)
-
-            if event.id in event_results:
-                end_date = connection.get_event_end_date(event)
-                if (not event.need_confirmation_doctor or event_results[event.id].doctor_confirmation) and (
-                        not event.need_confirmation_patient or event_results[event.id].patient_confirmation):
-                    if event.is_required:
-                        if (not event_results[event.id].doctor_confirmation or event_results[event.id].doctor_confirmation < end_date) \
-                                and (not event_results[event.id].patient_confirmation or event_results[event.id].patient_confirmation < end_date):
-                            event_status[event.id] = 'done'
-                        else:
-                            event_status[event.id] = 'delayed'
-                    else:
-                        if (not event_results[event.id].doctor_confirmation or event_results[event.id].doctor_confirmation < end_date) and \
-                                (not event_results[event.id].patient_confirmation or event_results[event.id].patient_confirmation < end_date):
-                            event_status[event.id] = 'done_additional'
-                        else:
-                            event_status[event.id] = 'delayed_additional'
-                else:
-                    if not event.need_confirmation_doctor and not event.need_confirmation_patient:
-                        event_status[event.id] = 'pass'
-                    else:
-                        if event.is_required:
-                            if today < end_date:
-                                event_status[event.id] = 'progress'
-                            else:
-                                event_status[event.id] = 'fail'
-                        else:
-                            if today < end_date:
-                                event_status[event.id] = 'progress_additional'
-                            else:
-                                event_status[event.id] = 'fail_additional'
-            else:
-                if today < connection.get_event_start_date(event):
-                    event_status[event.id] = 'pre'
-                else:
-                    event_status[event.id] = 'progress'
-
-        stats = {
-            "total": len(list(filter(lambda x: x.is_required, events))),
-            "additional_total": len(list(filter(lambda x: not x.is_required, events))),
-            "done": len(list(filter(lambda x: x == 'done', event_status.values()))),
-            "failed": len(list(filter(lambda x: x == 'fail', event_status.values()))),
-            "delayed": len(list(filter(lambda x: x == 'delay', event_status.values())))
-        }
         if client == 'doctor':
-            return render_template('protocol_doctor.html', events=events, event_results=event_results, protocol=protocol,
-                                   event_periods=event_periods, event_notifications=event_notifications,
-                                   event_status=event_status, stats=stats)
+            body = render_template('protocol_doctor.html', **context)
         else:
-            return render_template('protocol_patient.html', events=events, event_results=event_results, protocol=protocol,
-                                   event_periods=event_periods, event_notifications=event_notifications,
-                                   event_status=event_status, stats=stats)
+            body = render_template('protocol_patient.html', **context)
+
+        page_cache.set(etag, body)
+        return page_response(body, etag)
 
     except Exception as e:
         print(e, sys.exc_info()[-1].tb_lineno)
@@ -599,14 +1203,15 @@ def save_event(role, event_id):
             result.patient_confirmation = date if validate_date(date) else datetime.today().date()
             result.patient_comment = comment
             result.patient_confirmation_filled = datetime.today().date()
+        bump_version('contract', contract_id)
         db.session.commit()
 
         if not request.form.get('source'):
             return "<strong>Спасибо, окно можно закрыть</strong><script>window.parent.postMessage('close-modal-success','*');</script>"
         elif request.form.get('source') == 'doctor_protocol':
-            return protocol_page(event.protocol_id, 'doctor')
+            return render_protocol_page(event.protocol_id, 'doctor')
         else:
-            return protocol_page(event.protocol_id, 'patient')
+            return render_protocol_page(event.protocol_id, 'patient')
 
     except:
         return "error"
@@ -617,60 +1222,401 @@ def index():
     return 'waiting for the thunder!'
 
 
-def event_active(protocol: ContractProtocols, event):
-    if event.notification_day is None:
-        return False
+def get_due_schedule(today):
+    """(contract_id, event_id) of active contracts whose notification falls on today."""
+    return db.session.query(ContractEventSchedule.contract_id, ContractEventSchedule.event_id) \
+        .join(Contract, Contract.id == ContractEventSchedule.contract_id) \
+        .filter(ContractEventSchedule.notify_date == today, Contract.active == True)
 
-    today = datetime.today().date()
-    target_date = protocol.start + timedelta(days=event.notification_day)
 
-    return (today - target_date).days == 0
+def get_due_notifications(today):
+    """(connection, event) pairs whose notification falls on today, sent or not, in one joined query."""
+    return db.session.query(ContractProtocols, Event) \
+        .select_from(ContractEventSchedule) \
+        .join(Contract, Contract.id == ContractEventSchedule.contract_id) \
+        .join(Event, Event.id == ContractEventSchedule.event_id) \
+        .join(ContractProtocols, and_(ContractProtocols.contract_id == ContractEventSchedule.contract_id,
+                                      ContractProtocols.protocol_id == ContractEventSchedule.protocol_id)) \
+        .filter(ContractEventSchedule.notify_date == today,
+                Contract.active == True) \
+        .all()
+
+
+def acquire_sender_lock():
+    """Lets one replica scan at a time; the lock is released when the pass commits."""
+    if not is_postgres():
+        return True
+    return db.session.query(func.pg_try_advisory_xact_lock(SENDER_LOCK_KEY)).scalar()
+
+
+def insert_returning(statement, *columns):
+    """Executes an INSERT with RETURNING and returns the rows.
+
+    SQLite supports RETURNING since 3.35, but SQLAlchemy 1.4 only compiles it for Postgres, so for SQLite
+    the clause is appended to the compiled statement.
+    """
+    if is_postgres():
+        return db.session.execute(statement.returning(*columns)).all()
+
+    compiled = statement.compile(dialect=sqlite.dialect(paramstyle='named'))
+    params = [bindparam(name, bind.effective_value, type_=bind.type) for bind, name in compiled.bind_names.items()]
+    returning = text('{} RETURNING {}'.format(compiled, ', '.join(column.name for column in columns)))
+    return db.session.execute(returning.bindparams(*params)).all()
 
 
+def claim_due_results(today):
+    """Inserts the event_results rows of everything due today in one statement; returns the (contract_id,
+    event_id) pairs this process inserted, leaving the rows other replicas already own."""
+    claim = dialect_insert(EventResults) \
+        .from_select(['contract_id', 'event_id'], get_due_schedule(today).statement) \
+        .on_conflict_do_nothing()
+    return {tuple(row) for row in insert_returning(claim, EventResults.contract_id, EventResults.event_id)}
+
+
+def claim_result(contract_id, event_id):
+    """Inserts the event_results row unless another replica already did; True if this process owns the event."""
+    claim = dialect_insert(EventResults).values(contract_id=contract_id, event_id=event_id).on_conflict_do_nothing()
+    return db.session.execute(claim).rowcount == 1
+
+
+def get_event_message(connection, event, role):
+    if role == 'doctor':
+        return event.get_doctor_message(connection)
+    return event.get_patient_message(connection)
+
+
+def get_event_outbox_row(connection, event, role):
+    if getattr(event, 'need_confirmation_' + role):
+        action_link = "{}/event/{}".format(role, event.id)
+        action_name = "Подтвердить выполнение"
+    else:
+        action_link = None
+        action_name = None
+
+    return get_outbox_row(connection.contract_id, event.id, text=get_event_message(connection, event, role),
+                          only_doctor=role == 'doctor', only_patient=role == 'patient', action_link=action_link,
+                          action_name=action_name, action_onetime=True)
+
+
+def get_digest_outbox_row(contract_id, role, items, today):
+    """One message for all of a contract's events due today for the role.
+
+    A message carries a single action, so when several events need confirmation it opens the digest page,
+    which has a confirmation for each of them.
+    """
+    items = sorted(items, key=lambda item: (item[1].protocol_id, item[1].id))
+    text = "<b>Запланированные мероприятия</b><br><br>" + \
+           "<br><br>".join(get_event_message(connection, event, role) for connection, event in items)
+    confirmable = [event for connection, event in items if getattr(event, 'need_confirmation_' + role)]
+
+    if len(confirmable) == 1:
+        action_link = "{}/event/{}".format(role, confirmable[0].id)
+        action_name = "Подтвердить выполнение"
+    elif confirmable:
+        action_link = "{}/digest/{}".format(role, today.isoformat())
+        action_name = "Подтвердить выполнение"
+    else:
+        action_link = None
+        action_name = None
+
+    return get_outbox_row(contract_id, text=text, only_doctor=role == 'doctor', only_patient=role == 'patient',
+                          action_link=action_link, action_name=action_name, action_onetime=len(confirmable) == 1)
+
+
+def get_event_notify_dates(event_id):
+    return dict(db.session.query(ContractEventSchedule.contract_id, ContractEventSchedule.notify_date)
+                .filter(ContractEventSchedule.event_id == event_id))
+
+
+def reschedule_event(event, previous, today):
+    """Follows an edit of an event for the contracts attached to its protocol; call after refresh_event_schedule.
+
+    `previous` maps contract ids to notify dates from before the edit. A notification moved from today or
+    later to a day that has already passed is sent now rather than skipped, as long as the event has an end
+    date that hasn't passed. One that was already sent and is moved to a later day is re-armed: the
+    unconfirmed result and any undelivered messages are dropped, so the regular pass notifies again on the
+    new day. Undelivered messages for a role that is no longer notified are cancelled. Returns the contracts
+    that changed.
+    """
+    rows = db.session.query(ContractProtocols, ContractEventSchedule.notify_date, ContractEventSchedule.end_date,
+                            EventResults) \
+        .select_from(ContractEventSchedule) \
+        .join(Contract, Contract.id == ContractEventSchedule.contract_id) \
+        .join(ContractProtocols, and_(ContractProtocols.contract_id == ContractEventSchedule.contract_id,
+                                      ContractProtocols.protocol_id == ContractEventSchedule.protocol_id)) \
+        .outerjoin(EventResults, and_(EventResults.contract_id == ContractEventSchedule.contract_id,
+                                      EventResults.event_id == ContractEventSchedule.event_id)) \
+        .filter(ContractEventSchedule.event_id == event.id, Contract.active == True).all()
+
+    roles = [role for role in ('doctor', 'patient') if getattr(event, 'notify_' + role)]
+    changed = set()
+    rearmed = []
+    outbox = []
+
+    for connection, notify_date, end_date, result in rows:
+        if notify_date is None or not roles:
+            continue
+
+        contract_id = connection.contract_id
+        before = previous.get(contract_id)
+
+        # without an end date there's no telling whether the event is long over, so it isn't caught up
+        if notify_date < today and (before is None or before >= today) and result is None and \
+                end_date is not None and end_date >= today:
+            if claim_result(contract_id, event.id):
+                outbox.extend(get_event_outbox_row(connection, event, role) for role in roles)
+                changed.add(contract_id)
+        elif notify_date > today and before is not None and before <= today and result is not None and \
+                not (result.patient_confirmation or result.doctor_confirmation or result.patient_comment or
+                     result.doctor_comment):
+            rearmed.append(contract_id)
+
+    enqueue_messages(outbox)
+
+    if rearmed:
+        EventResults.query.filter(EventResults.event_id == event.id, EventResults.contract_id.in_(rearmed),
+                                  EventResults.patient_confirmation == None, EventResults.doctor_confirmation == None,
+                                  EventResults.patient_comment == None, EventResults.doctor_comment == None) \
+            .delete(synchronize_session=False)
+        changed.update(rearmed)
+
+    for message in OutboxMessage.query.filter(OutboxMessage.event_id == event.id, OutboxMessage.status == 'pending'):
+        role = get_message_role(message.message)
+
+        if message.contract_id in rearmed or role not in roles:
+            message.status = 'cancelled'
+            notifications.inc(role=role, result='cancelled')
+            changed.add(message.contract_id)
+
+    bump_versions('contract', changed)
+
+    return changed
+
+
+@query_stats.track('send_iteration', report=True)
 def send_iteration():
-    contracts = Contract.query.all()
-
-    for contract in contracts:
-        for protocol in contract.protocols:
-            for event in protocol.events:
-                if event_active(protocol.get_connection(contract), event) and EventResults.query.filter_by(
-                        event_id=event.id, contract_id=contract.id).count() == 0:
-                    result = EventResults(event_id=event.id, contract_id=contract.id)
-                    db.session.add(result)
-
-                    if event.notify_doctor:
-                        text = event.get_doctor_message(protocol.get_connection(contract))
-
-                        if event.need_confirmation_doctor:
-                            action_link = "doctor/event/{}".format(event.id)
-                            action_name = "Подтвердить выполнение"
-                        else:
-                            action_link = None
-                            action_name = None
-
-                        send_message(contract_id=contract.id, text=text, only_doctor=True, action_link=action_link,
-                                     action_name=action_name, action_onetime=True)
-
-                    if event.notify_patient:
-                        text = event.get_patient_message(protocol.get_connection(contract))
-
-                        if event.need_confirmation_patient:
-                            action_link = "patient/event/{}".format(event.id)
-                            action_name = "Подтвердить выполнение"
-                        else:
-                            action_link = None
-                            action_name = None
-
-                        send_message(contract_id=contract.id, text=text, only_patient=True, action_link=action_link,
-                                     action_name=action_name, action_onetime=True)
+    started = time.perf_counter()
+    today = datetime.today().date()
+
+    if not acquire_sender_lock():
+        db.session.rollback()
+        return
+
+    claimed = claim_due_results(today)
+    due = get_due_notifications(today) if claimed else []
+    groups = {}
+
+    for connection, event in due:
+        if (connection.contract_id, event.id) not in claimed:
+            continue
+
+        for role in ('doctor', 'patient'):
+            if getattr(event, 'notify_' + role):
+                groups.setdefault((connection.contract_id, role), []).append((connection, event))
+
+    outbox = []
+    for (contract_id, role), items in groups.items():
+        if DIGEST_MODE and len(items) >= DIGEST_MIN_EVENTS:
+            outbox.append(get_digest_outbox_row(contract_id, role, items, today))
+        else:
+            outbox.extend(get_event_outbox_row(connection, event, role) for connection, event in items)
+
+    enqueue_messages(outbox)
+
+    # the new event_results rows change the contracts' pages even when nobody gets a message
+    bump_versions('contract', {contract_id for contract_id, event_id in claimed})
 
     db.session.commit()
-    time.sleep(60 * 5)
+    outbox_ready.set()
+
+    send_iteration_duration.observe(time.perf_counter() - started)
+    send_iteration_contracts.set(len({contract_id for contract_id, event_id in claimed}))
+    send_iteration_events.set(len(claimed))
+
+
+def get_notification_dates(after):
+    """Distinct notification dates later than `after` across active contracts."""
+    return [row[0] for row in db.session.query(ContractEventSchedule.notify_date).distinct()
+        .join(Contract, Contract.id == ContractEventSchedule.contract_id)
+        .filter(Contract.active == True, ContractEventSchedule.notify_date > after)]
+
+
+def schedule_changed():
+    """Marks notification dates as changed for schedulers in other processes; call before the commit."""
+    bump_version('schedule', 0)
+
+
+class NotificationSchedule:
+    """In-memory priority queue of upcoming notification dates.
+
+    The sender sleeps until the earliest queued date begins. Anything that changes contracts, attached
+    protocols or events calls invalidate(), which wakes the sender and rebuilds the queue before the next sleep.
+    A scheduler running in its own process doesn't see those calls, so while sleeping it also polls the
+    ('schedule', 0) version bumped by schedule_changed() every SCHEDULER_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.dates = []
+        self.stale = True
+        self.version = None
+        self.changed = threading.Event()
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.stale = True
+        self.changed.set()
+
+    def next_date(self, today):
+        with self.lock:
+            if self.stale:
+                self.version = get_versions(('schedule', 0))[0]
+                self.dates = get_notification_dates(today)
+                heapq.heapify(self.dates)
+                self.stale = False
+
+            while self.dates and self.dates[0] <= today:
+                heapq.heappop(self.dates)
+
+            return self.dates[0] if self.dates else None
+
+    def wait(self):
+        now = datetime.now()
+        next_date = self.next_date(now.date())
+        timeout = SCHEDULER_MAX_SLEEP
+
+        if next_date:
+            timeout = min(timeout, (datetime.combine(next_date, datetime.min.time()) - now).total_seconds())
+
+        db.session.remove()
+        deadline = time.monotonic() + timeout
+
+        while not self.changed.wait(max(min(deadline - time.monotonic(), SCHEDULER_POLL_INTERVAL), 0)):
+            if time.monotonic() >= deadline or self.poll():
+                return
+
+    def poll(self):
+        version = get_versions(('schedule', 0))[0]
+        db.session.remove()
+
+        if version != self.version:
+            self.invalidate()
+            return True
+        return False
+
+
+schedule = NotificationSchedule()
 
 
 def sender():
     while True:
-        send_iteration()
+        schedule.changed.clear()
+
+        try:
+            send_iteration()
+            schedule.wait()
+        except Exception as e:
+            print("{}: Send iteration failed: {}".format(gts(), e))
+            db.session.rollback()
+            schedule.invalidate()
+            time.sleep(SCHEDULER_RETRY_DELAY)
+
+
+outbox_ready = threading.Event()
+
+
+def get_outbox_row(contract_id, event_id=None, **kwargs):
+    """Outbox row for enqueue_messages; event_id marks a message about a single event, so that rescheduling
+    the event can cancel it."""
+    return {'contract_id': contract_id, 'event_id': event_id, 'message': json.dumps(make_message(**kwargs))}
+
+
+def enqueue_messages(rows):
+    """Adds messages to the outbox in the current transaction with one executemany INSERT; the dispatcher
+    delivers them after commit."""
+    if rows:
+        db.session.execute(insert(OutboxMessage), rows)
+
+
+def get_retry_delay(attempts):
+    return timedelta(seconds=min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_RETRY_DELAY))
+
+
+def get_pending_outbox(now):
+    return OutboxMessage.query.filter(OutboxMessage.status == 'pending', OutboxMessage.next_attempt <= now) \
+        .order_by(OutboxMessage.next_attempt, OutboxMessage.id).limit(OUTBOX_BATCH_SIZE)
+
+
+def claim_outbox_batch(now):
+    """Leases a batch of due messages to this process for OUTBOX_CLAIM_TIMEOUT seconds.
+
+    SKIP LOCKED lets concurrent replicas claim disjoint batches; if a process dies mid-send,
+    its lease runs out and the messages are picked up again.
+    """
+    batch = get_pending_outbox(now).with_for_update(skip_locked=True).all()
+
+    claimed = [(item.id, item.contract_id, item.message, item.attempts) for item in batch]
+    for item in batch:
+        item.next_attempt = now + timedelta(seconds=OUTBOX_CLAIM_TIMEOUT)
+
+    db.session.commit()
+    return claimed
+
+
+def get_message_role(message):
+    message = json.loads(message)
+    if message.get('only_doctor'):
+        return 'doctor'
+    if message.get('only_patient'):
+        return 'patient'
+    return 'all'
+
+
+@query_stats.track('dispatch_outbox')
+def dispatch_outbox():
+    batch = claim_outbox_batch(datetime.now())
+    errors = client.send_many([(contract_id, json.loads(message)) for _, contract_id, message, _ in batch])
+
+    for (id, contract_id, message, attempts), e in zip(batch, errors):
+        notifications.inc(role=get_message_role(message), result='sent' if e is None else 'failed')
+
+    sent = [item[0] for item, e in zip(batch, errors) if e is None]
+    if sent:
+        OutboxMessage.query.filter(OutboxMessage.id.in_(sent)) \
+            .update({'status': 'sent', 'sent': datetime.now()}, synchronize_session=False)
+
+    for (id, contract_id, message, attempts), e in zip(batch, errors):
+        if e is None:
+            continue
+
+        attempts += 1
+        values = {'attempts': attempts, 'last_error': str(e)}
+
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            values['status'] = 'dead'
+            notifications.inc(role=get_message_role(message), result='dead')
+            print("{}: Outbox message {} is dead after {} attempts: {}".format(gts(), id, attempts, e))
+        else:
+            values['next_attempt'] = datetime.now() + get_retry_delay(attempts)
+
+        OutboxMessage.query.filter_by(id=id).update(values, synchronize_session=False)
+
+    db.session.commit()
+    return len(batch)
+
+
+def dispatcher():
+    while True:
+        outbox_ready.clear()
+
+        try:
+            if dispatch_outbox() == OUTBOX_BATCH_SIZE:
+                continue
+        except Exception as e:
+            print("{}: Outbox dispatch failed: {}".format(gts(), e))
+            db.session.rollback()
+
+        outbox_ready.wait(OUTBOX_POLL_INTERVAL)
 
 
 @app.route('/message', methods=['POST'])
@@ -691,6 +1637,108 @@ def editor():
     return render_template('editor/index.html', protocols=protocols)
 
 
+def iter_exported_protocols(protocol_ids=None):
+    """Protocols with their events, one at a time; events are read as plain rows in EXPORT_BATCH_SIZE batches."""
+    protocols = Protocol.query.order_by(Protocol.id)
+    events = db.session.query(Event.id, Event.protocol_id, *[getattr(Event, name) for name in EVENT_FIELDS]) \
+        .order_by(Event.protocol_id, Event.id)
+
+    if protocol_ids:
+        protocols = protocols.filter(Protocol.id.in_(protocol_ids))
+        events = events.filter(Event.protocol_id.in_(protocol_ids))
+
+    protocols = protocols.all()
+    events = iter(events.yield_per(EXPORT_BATCH_SIZE))
+    event = next(events, None)
+
+    for protocol in protocols:
+        items = []
+        while event is not None and event.protocol_id <= protocol.id:
+            if event.protocol_id == protocol.id:
+                items.append(event)
+            event = next(events, None)
+
+        yield dump_protocol(protocol, items)
+
+
+def export_response(protocol_ids=None):
+    protocols = iter_exported_protocols(protocol_ids)
+
+    if request.args.get('format') == 'ndjson':
+        body = (json.dumps(protocol, ensure_ascii=False) + '\n' for protocol in protocols)
+        mimetype, extension = 'application/x-ndjson', 'ndjson'
+    else:
+        def body_parts():
+            yield '{"protocols": ['
+            for number, protocol in enumerate(protocols):
+                yield (',\n' if number else '\n') + json.dumps(protocol, ensure_ascii=False)
+            yield '\n]}\n'
+
+        body = body_parts()
+        mimetype, extension = 'application/json', 'json'
+
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=protocols.{}'.format(extension)})
+
+
+@app.route('/editor/export')
+@auth.login_required
+def export_protocols():
+    return export_response(request.args.getlist('protocol_id', type=int))
+
+
+@app.route('/editor/<int:id>/export')
+@auth.login_required
+def export_protocol(id):
+    return export_response([id])
+
+
+@app.route('/editor/import', methods=['POST'])
+@auth.login_required
+def import_protocols():
+    """Creates protocols from a JSON or NDJSON export in one transaction.
+
+    The upload is read item by item: every protocol is validated and inserted as soon as it is parsed, with
+    its events going in as executemany batches, and any invalid item rolls the whole import back.
+    """
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    name = upload.filename or '' if upload else ''
+
+    if request.args.get('format') == 'ndjson' or request.mimetype == 'application/x-ndjson' or \
+            name.endswith('.ndjson'):
+        items = iter_ndjson(stream)
+    else:
+        items = iter_json_array(stream)
+
+    imported = []
+
+    try:
+        for where, data in items:
+            protocol, events = validate_protocol(data, where)
+            protocol_id = db.session.execute(insert(Protocol).values(**protocol)).inserted_primary_key[0]
+
+            for start in range(0, len(events), IMPORT_BATCH_SIZE):
+                db.session.execute(insert(Event), [dict(event, protocol_id=protocol_id)
+                                                   for event in events[start:start + IMPORT_BATCH_SIZE]])
+
+            imported.append({"id": protocol_id, "title": protocol['title'], "events": len(events)})
+
+        bump_version('catalog', 0)
+        db.session.commit()
+    except InvalidImport as e:
+        db.session.rollback()
+        if upload:
+            return "<strong>Ошибка импорта:</strong> {}".format(e), 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False), 400, {'Content-Type': 'application/json'}
+
+    print("{}: Imported {} protocols".format(gts(), len(imported)))
+
+    if upload:
+        return redirect('/editor')
+    return json.dumps({"imported": imported}, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+
 @app.route('/editor/add')
 @auth.login_required
 def add_protocol_page():
@@ -704,6 +1752,7 @@ def add_protocol():
 
     if protocol.title and protocol.description:
         db.session.add(protocol)
+        bump_version('catalog', 0)
         db.session.commit()
         return redirect('/editor')
     else:
@@ -725,6 +1774,8 @@ def edit_protocol(id):
     protocol.description = request.form.get('description')
 
     if protocol.title and protocol.description:
+        bump_version('protocol', id)
+        bump_version('catalog', 0)
         db.session.commit()
         return redirect('/editor')
     else:
@@ -735,7 +1786,10 @@ def edit_protocol(id):
 @auth.login_required
 def delete_protocol(id):
     protocol = Protocol.query.get(id)
+    ContractEventSchedule.query.filter_by(protocol_id=id).delete(synchronize_session=False)
     db.session.delete(protocol)
+    bump_version('protocol', id)
+    bump_version('catalog', 0)
     db.session.commit()
     return redirect('/editor')
 
@@ -779,7 +1833,12 @@ def add_event(id):
 
     if event.patient_title and event.start_day != None:
         db.session.add(event)
+        db.session.flush()
+        refresh_event_schedule(event_id=event.id)
+        bump_version('protocol', id)
+        schedule_changed()
         db.session.commit()
+        schedule.invalidate()
         return redirect('/editor/{}'.format(id))
     else:
         return render_template('editor/create_event.html', event=event)
@@ -796,6 +1855,8 @@ def edit_event_page(id):
 @auth.login_required
 def edit_event(id):
     event = Event.query.get(id)
+    previous = get_event_notify_dates(id)
+
     event.patient_title = filter_empty_string(request.form.get('patient_title'))
     event.patient_description = filter_empty_string(request.form.get('patient_description'))
 
@@ -817,7 +1878,17 @@ def edit_event(id):
     event.need_comment_patient = request.form.get('need_comment_patient') == "on"
 
     if event.patient_title and event.start_day != None:
+        refresh_event_schedule(event_id=id)
+        changed = reschedule_event(event, previous, datetime.today().date())
+        bump_version('protocol', event.protocol_id)
+        schedule_changed()
         db.session.commit()
+        schedule.invalidate()
+
+        if changed:
+            print("{}: Rescheduled event {} for {} contracts".format(gts(), id, len(changed)))
+            outbox_ready.set()
+
         return redirect('/editor/{}'.format(event.protocol_id))
     else:
         return render_template('editor/create_event.html', event=event)
@@ -827,12 +1898,67 @@ def edit_event(id):
 @auth.login_required
 def delete_event(id):
     event = Event.query.get(id)
+    ContractEventSchedule.query.filter_by(event_id=id).delete(synchronize_session=False)
+
+    # queued notifications would link to the deleted event, like those of an edit that stops notifying
+    changed = set()
+    for message in OutboxMessage.query.filter(OutboxMessage.event_id == id, OutboxMessage.status == 'pending'):
+        message.status = 'cancelled'
+        notifications.inc(role=get_message_role(message.message), result='cancelled')
+        changed.add(message.contract_id)
+
     db.session.delete(event)
+    bump_version('protocol', event.protocol_id)
+    bump_versions('contract', changed)
     db.session.commit()
     return redirect('/editor/{}'.format(event.protocol_id))
 
 
-t = Thread(target=sender)
-t.start()
+def create_app():
+    """Application for a WSGI server (see wsgi.py): no sender or dispatcher threads and no migrations here.
+
+    Under gunicorn the workers share their metrics through METRICS_MULTIPROC_DIR (see gunicorn.conf.py).
+    """
+    if METRICS_MULTIPROC_DIR:
+        metrics.share(METRICS_MULTIPROC_DIR, METRICS_SHARE_INTERVAL)
+    return app
+
+
+def start_workers():
+    threads = [Thread(target=sender, name='sender'), Thread(target=dispatcher, name='dispatcher')]
+    for thread in threads:
+        thread.start()
+    return threads
 
-app.run(port=PORT, host=HOST)
+
+def migrate():
+    init_db()
+    print("{}: Database structure is up to date".format(gts()))
+
+
+def run_scheduler():
+    """Sender and dispatcher without the web app; run exactly one such process next to the WSGI workers.
+
+    It migrates the database on start and serves its own metrics on SCHEDULER_METRICS_PORT, since the
+    sender and dispatcher counters live in this process and not in the web workers.
+    """
+    migrate()
+
+    if SCHEDULER_METRICS_PORT:
+        metrics.serve(HOST, SCHEDULER_METRICS_PORT)
+
+    print("{}: Scheduler started".format(gts()))
+
+    for thread in start_workers():
+        thread.join()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['scheduler']:
+        run_scheduler()
+    elif sys.argv[1:] == ['migrate']:
+        migrate()
+    else:
+        init_db()
+        start_workers()
+        app.run(port=PORT, host=HOST)
@@ -0,0 +1,210 @@
+import codecs
+import json
+import re
+
+# name: (type, max length, required, default); defaults follow the model columns, so every row has the same
+# keys and a batch of rows can go into one executemany INSERT
+PROTOCOL_FIELDS = {
+    "title": (str, 512, True, None),
+    "description": (str, None, True, None),
+}
+
+EVENT_FIELDS = {
+    "is_required": (bool, None, False, True),
+    "patient_title": (str, 512, True, None),
+    "patient_description": (str, None, False, None),
+    "doctor_title": (str, 512, False, None),
+    "doctor_description": (str, None, False, None),
+    "start_day": (int, None, True, None),
+    "end_day": (int, None, False, None),
+    "notification_day": (int, None, False, None),
+    "notify_doctor": (bool, None, False, False),
+    "notify_patient": (bool, None, False, False),
+    "need_confirmation_doctor": (bool, None, False, False),
+    "need_confirmation_patient": (bool, None, False, False),
+    "need_comment_doctor": (bool, None, False, False),
+    "need_comment_patient": (bool, None, False, False),
+}
+
+# exported for reference, ignored on import: records always get new ids
+IGNORED_FIELDS = {"id", "protocol_id"}
+
+JSON_PREFIX = re.compile(r'\s*(\[|\{\s*"protocols"\s*:\s*\[)')
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+def validate_fields(data, fields, where):
+    if not isinstance(data, dict):
+        raise InvalidImport("{}: expected an object".format(where))
+
+    unknown = set(data) - set(fields) - IGNORED_FIELDS
+    if unknown:
+        raise InvalidImport("{}: unknown fields {}".format(where, ', '.join(sorted(unknown))))
+
+    row = {}
+    for name, (kind, max_length, required, default) in fields.items():
+        value = data.get(name)
+
+        if value is None or value == '':
+            if required:
+                raise InvalidImport("{}: {} is required".format(where, name))
+            row[name] = default if name not in data or kind is bool else None
+            continue
+
+        # bool is a subclass of int, so true must not pass as a day number
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            raise InvalidImport("{}: {} must be {}".format(where, name, kind.__name__))
+        if max_length and len(value) > max_length:
+            raise InvalidImport("{}: {} is longer than {}".format(where, name, max_length))
+
+        row[name] = value
+
+    return row
+
+
+def apply_event_rules(row):
+    """Drops flags the editor can't set either (see add_event): notifications need a notification day, and
+    confirmations need the notification they are asked in."""
+    for role in ('doctor', 'patient'):
+        row['notify_' + role] = row['notify_' + role] and row['notification_day'] is not None
+        row['need_confirmation_' + role] = row['need_confirmation_' + role] and row['notify_' + role]
+    return row
+
+
+def validate_protocol(data, where):
+    """Checks one exported protocol; returns the Protocol row and the list of Event rows."""
+    if not isinstance(data, dict):
+        raise InvalidImport("{}: expected an object".format(where))
+
+    events = data.get('events') or []
+    if not isinstance(events, list):
+        raise InvalidImport("{}: events must be a list".format(where))
+
+    protocol = validate_fields({key: value for key, value in data.items() if key != 'events'}, PROTOCOL_FIELDS, where)
+    rows = [apply_event_rules(validate_fields(event, EVENT_FIELDS, "{}, event {}".format(where, number)))
+            for number, event in enumerate(events, 1)]
+
+    return protocol, rows
+
+
+def dump_protocol(protocol, events):
+    data = {"id": protocol.id}
+    data.update({name: getattr(protocol, name) for name in PROTOCOL_FIELDS})
+    data["events"] = [dict({"id": event.id}, **{name: getattr(event, name) for name in EVENT_FIELDS})
+                      for event in events]
+    return data
+
+
+def iter_ndjson(stream):
+    """Yields (location, object) for every non-empty line of a binary stream."""
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            yield "line {}".format(number), json.loads(line)
+        except ValueError as e:
+            raise InvalidImport("line {}: {}".format(number, e))
+
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """Yields (location, object) for the items of `[...]` or `{"protocols": [...]}` without loading the document.
+
+    Items are decoded one by one from a buffer that only holds the item being read.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    finished = False
+    consumed = 0
+    invalid_at = None
+    number = 0
+
+    def read():
+        nonlocal buffer, finished, consumed, invalid_at
+        # the items before an invalid byte are still yielded, so the error names the item that contains it
+        if invalid_at is not None:
+            raise InvalidImport("protocol {}: invalid UTF-8 at byte {}".format(number + 1, invalid_at))
+
+        chunk = stream.read(chunk_size) or b''
+        finished = not chunk
+        pending = utf8.getstate()[0]
+
+        try:
+            buffer += utf8.decode(chunk, final=finished)
+        except UnicodeDecodeError as e:
+            buffer += (pending + chunk)[:e.start].decode('utf-8')
+            invalid_at = consumed - len(pending) + e.start
+            finished = False
+
+        consumed += len(chunk)
+
+    while True:
+        read()
+        prefix = JSON_PREFIX.match(buffer)
+        if prefix:
+            buffer = buffer[prefix.end():]
+            # the wrapper object has to be closed after the list
+            closing = '' if prefix.group(1) == '[' else '}'
+            break
+        if finished or len(buffer) > 1024:
+            raise InvalidImport("expected a list of protocols or an object with a protocols list")
+
+    expect_item = True
+
+    while True:
+        buffer = buffer.lstrip()
+
+        if not buffer:
+            if finished:
+                raise InvalidImport("unexpected end of document")
+            read()
+            continue
+
+        if buffer[0] == ']':
+            if expect_item and number:
+                raise InvalidImport("protocol {}: expected an object after ','".format(number + 1))
+            buffer = buffer[1:]
+            break
+        if not expect_item:
+            if buffer[0] == '{':
+                raise InvalidImport("missing ',' between protocol {} and protocol {}".format(number, number + 1))
+            if buffer[0] != ',':
+                raise InvalidImport("expected ',' or ']' after protocol {}".format(number))
+            buffer = buffer[1:]
+            expect_item = True
+            continue
+        if buffer[0] != '{':
+            raise InvalidImport("protocol {}: expected an object".format(number + 1))
+
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except ValueError as e:
+            if finished:
+                raise InvalidImport("protocol {}: {}".format(number + 1, e))
+            read()
+            continue
+
+        number += 1
+        buffer = buffer[end:]
+        expect_item = False
+        yield "protocol {}".format(number), item
+
+    while True:
+        buffer = buffer.lstrip()
+
+        if closing and buffer[:1] == closing:
+            buffer = buffer[1:]
+            closing = ''
+        elif buffer:
+            raise InvalidImport("unexpected data after the protocols list")
+        elif finished:
+            if closing:
+                raise InvalidImport("unexpected end of document")
+            return
+        else:
+            read()
@@ -0,0 +1,120 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats:
+    def __init__(self, name, budget=None):
+        self.name = name
+        self.budget = budget
+        self.count = 0
+        self.duration = 0.0
+        self.started = time.perf_counter()
+        self.outer = None
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        return "{} queries, {:.1f} ms in the database of {:.1f} ms".format(self.count, self.duration * 1000,
+                                                                          self.elapsed * 1000)
+
+
+settings = {
+    "slow_query_threshold": 0.1,
+    "budgets": {},
+    "strict": False,
+}
+
+_local = threading.local()
+
+
+def configure(slow_query_threshold=None, budgets=None, strict=None):
+    if slow_query_threshold is not None:
+        settings['slow_query_threshold'] = slow_query_threshold
+    if budgets is not None:
+        settings['budgets'] = budgets
+    if strict is not None:
+        settings['strict'] = strict
+
+
+def current():
+    return getattr(_local, 'stats', None)
+
+
+def start(name):
+    """Begins counting statements issued by this thread under the given name (an endpoint or a job)."""
+    stats = QueryStats(name, settings['budgets'].get(name))
+    stats.outer = current()
+    _local.stats = stats
+    return stats
+
+
+def stop():
+    """Ends the innermost tracking scope and checks it against its query budget."""
+    stats = current()
+    if stats is None:
+        return None
+
+    _local.stats = stats.outer
+    if stats.outer:
+        stats.outer.count += stats.count
+        stats.outer.duration += stats.duration
+
+    if stats.budget is not None and stats.count > stats.budget:
+        message = "{} ran {}, budget is {} queries".format(stats.name, stats.summary(), stats.budget)
+        if settings['strict']:
+            raise QueryBudgetExceeded(message)
+        log(message)
+
+    return stats
+
+
+@contextmanager
+def track(name, report=False):
+    """Tracks a block or, as a decorator, every call; with report on, each run logs its queries and DB time."""
+    stats = start(name)
+    try:
+        yield stats
+    finally:
+        stop()
+        if report:
+            log("{}: {}".format(name, stats.summary()))
+
+
+def log(message):
+    print("{}: {}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), message))
+
+
+def install(engine):
+    """Counts statements and DB time per tracking scope and logs statements slower than the threshold."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_started'].pop()
+        stats = current()
+
+        if stats:
+            stats.count += 1
+            stats.duration += duration
+
+        if duration > settings['slow_query_threshold']:
+            log("slow query ({:.1f} ms) in {}: {}".format(duration * 1000, stats.name if stats else '-',
+                                                           ' '.join(statement.split())[:1000]))
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection else None
+        if started:
+            started.pop()
@@ -0,0 +1,33 @@
+"""Production entry points.
+
+Database structure, once per deploy before the web workers start (the scheduler also runs it on start):
+
+    python protocol-bot.py migrate
+
+Web, any number of workers, no background threads; /metrics adds up all workers:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Scheduler and outbox dispatcher, exactly one process (replicas also coordinate through the database, see
+acquire_sender_lock and claim_outbox_batch); its metrics are served on SCHEDULER_METRICS_PORT:
+
+    python protocol-bot.py scheduler
+
+`python protocol-bot.py` alone still runs everything in one process on the Flask development server.
+"""
+import importlib.util
+import os
+import sys
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location('protocol_bot', os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'protocol-bot.py'))
+    bot = importlib.util.module_from_spec(spec)
+    sys.modules['protocol_bot'] = bot
+    spec.loader.exec_module(bot)
+    return bot
+
+
+bot = load_bot()
+app = bot.create_app()